@@ -1,7 +1,12 @@
 from ..envault import reload
 
 reload("src", ["core", "events", "logging", "settings", "config_file",
-               "config_status", "env_cache", "envault_data", "envault_request"])
+               "config_status", "env_store", "env_cache", "envault_data",
+               "disk_cache", "ssl_context", "content_encoding",
+               "connection_pool", "resilience", "fetch_registry",
+               "fetch_executor", "async_fetch", "envault_request",
+               "fetch_batcher", "command_hosts",
+               "command_matcher", "timings"])
 reload("src.commands")
 
 from . import core
@@ -26,4 +31,5 @@ __all__ = [
     "EnvaultCreateConfigCommand",
     "EnvaultOpenConfigCommand",
     "EnvaultShowVariablesCommand",
+    "EnvaultShowTimingsCommand",
 ]
@@ -0,0 +1,329 @@
+import asyncio
+
+from .settings import ev_settings
+from .logging import log
+from .ssl_context import get_ssl_context
+from .content_encoding import ContentDecoder
+from .resilience import with_retries
+from .connection_pool import READ_CHUNK_SIZE, request_target, proxy_for, pooled_request
+
+from functools import partial
+
+from http.client import parse_headers
+
+from io import BytesIO
+
+from socket import timeout as SocketTimeout
+
+from threading import Thread, Lock
+
+from urllib.error import URLError, HTTPError
+from urllib.parse import urlparse
+
+
+## ----------------------------------------------------------------------------
+
+
+class _TimedReader():
+    """
+    A wrapper around an asyncio stream reader that limits how long each read
+    is allowed to wait for data to arrive.
+    """
+    def __init__(self, reader, timeout):
+        self.reader = reader
+        self.timeout = timeout
+
+    async def read(self, n):
+        return await asyncio.wait_for(self.reader.read(n), self.timeout)
+
+    async def readexactly(self, n):
+        return await asyncio.wait_for(self.reader.readexactly(n), self.timeout)
+
+    async def readuntil(self, separator):
+        return await asyncio.wait_for(self.reader.readuntil(separator), self.timeout)
+
+
+## ----------------------------------------------------------------------------
+
+
+async def _read_body(reader, status, headers):
+    """
+    Read and return the body of an HTTP response from the stream reader given,
+    using the response status and headers to know how the body is framed. The
+    body is decoded as it is read, according to its Content-Encoding.
+    """
+    if status in (204, 304) or 100 <= status < 200:
+        return b""
+
+    decoder = ContentDecoder(headers.get("Content-Encoding"))
+
+    if headers.get("Transfer-Encoding", "").lower() == "chunked":
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            if size == 0:
+                await reader.readuntil(b"\r\n")
+                return decoder.finish()
+
+            decoder.feed(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    length = headers.get("Content-Length")
+    remaining = int(length) if length is not None else None
+    while remaining is None or remaining > 0:
+        size = READ_CHUNK_SIZE if remaining is None else min(remaining, READ_CHUNK_SIZE)
+        chunk = await reader.read(size)
+        if not chunk:
+            if remaining is not None:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            break
+
+        decoder.feed(chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
+
+    return decoder.finish()
+
+
+async def _proxied_request(method, url, body, headers, connect_timeout, read_timeout,
+                           token):
+    """
+    Make a single HTTP request to the given URL through the proxy configured
+    for it, and return a tuple of the status, reason, headers and body of the
+    response.
+
+    This hands the request to the connection pool on a worker thread, since
+    it knows how to talk to proxies; cancelling the token aborts it.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        res = await loop.run_in_executor(None, partial(
+            pooled_request, method, url, body, headers,
+            connect_timeout=connect_timeout, read_timeout=read_timeout, token=token))
+
+    except HTTPError as e:
+        return e.code, e.reason, e.headers, e.read()
+
+    return res.status, res.reason, res.headers, res.body
+
+
+async def _http_request(method, url, body, headers, connect_timeout, read_timeout,
+                        token=None):
+    """
+    Make a single HTTP request to the given URL over a new non-blocking
+    connection, and return a tuple of the status, reason, headers and body of
+    the response.
+
+    Making the connection is limited by connect_timeout, and each read from
+    the connection by read_timeout. Requests that have to go through a proxy
+    are made by _proxied_request() instead.
+    """
+    if proxy_for(url) is not None:
+        return await _proxied_request(method, url, body, headers,
+                                      connect_timeout, read_timeout, token)
+
+    scheme, host, port, target = request_target(url)
+    https = scheme == "https"
+
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(
+        host, port, ssl=get_ssl_context() if https else None,
+        server_hostname=host if https else None), connect_timeout)
+    reader = _TimedReader(reader, read_timeout)
+
+    try:
+        # This connection is only used for a single request, so override any
+        # keep-alive that the request would otherwise ask for.
+        request_headers = dict(headers)
+        request_headers["Host"] = urlparse(url).netloc
+        request_headers["Connection"] = "close"
+        request_headers["Content-Length"] = str(len(body))
+
+        lines = [f"{method} {target} HTTP/1.1"]
+        lines.extend(f"{k}: {v}" for k, v in request_headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await asyncio.wait_for(writer.drain(), read_timeout)
+
+        status_line = (await reader.readuntil(b"\r\n")).decode("latin-1")
+        _, status, reason = (status_line.strip().split(" ", 2) + [""])[:3]
+
+        header_block = await reader.readuntil(b"\r\n\r\n")
+        res_headers = parse_headers(BytesIO(header_block))
+
+        status = int(status)
+        return status, reason, res_headers, await _read_body(reader, status, res_headers)
+
+    finally:
+        writer.close()
+
+
+## ----------------------------------------------------------------------------
+
+
+class AsyncFetchLoop():
+    """
+    An asyncio event loop that runs in a single long lived background thread,
+    used to make Envault requests as coroutines on non-blocking sockets rather
+    than tying up an OS thread for each request in progress.
+
+    The loop is started the first time a request is submitted, and runs until
+    it is stopped; the results of requests are handed back to the main thread
+    by the request itself.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._loop = None
+        self._thread = None
+
+        # Semaphores that limit the number of requests in progress to each
+        # host; these belong to the loop and are only touched from it.
+        self._host_limits = {}
+
+
+    def _run_loop(self, loop):
+        """
+        The body of the background thread; this runs the loop until it is
+        stopped, then cancels anything that is still pending and closes it.
+        """
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+
+
+    def _ensure_running(self):
+        """
+        Start the loop and its thread if they are not already running, and
+        return the loop.
+        """
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._host_limits = {}
+                self._thread = Thread(target=self._run_loop, args=(self._loop,),
+                                      daemon=True)
+                self._thread.start()
+
+            return self._loop
+
+
+    async def _fetch(self, request):
+        """
+        Run the given EnvaultRequest to completion; this is the coroutine
+        version of EnvaultRequest.run().
+
+        If the request is cancelled, the task is cancelled where it stands,
+        which closes its connection, and the callback is never invoked.
+        """
+        env_keys = None
+        try:
+            env_keys = await self._fetch_env(request)
+        except Exception as e:
+            request.report_unexpected_error(e)
+
+        # Cancelling the task raises CancelledError, which is not an Exception
+        # and so skips this; anything else has to complete the request, or
+        # the fetch would stay in flight forever.
+        request.complete(env_keys)
+
+
+    async def _fetch_env(self, request):
+        """
+        Make the request, retrying it as needed, and return the resulting
+        dictionary of environment variables, or None if it failed.
+        """
+        limit = self._host_limits.get(request.host)
+        if limit is None:
+            limit = asyncio.Semaphore(max(1, ev_settings().fetch_host_limit))
+            self._host_limits[request.host] = limit
+
+        request.log_request()
+
+        async def attempt():
+            try:
+                async with limit:
+                    status, reason, headers, body = await _http_request(
+                        "POST", request.url, request.request_body(),
+                        request.request_headers(),
+                        ev_settings().connect_timeout,
+                        ev_settings().read_timeout,
+                        request.token)
+
+            except asyncio.TimeoutError:
+                raise URLError(SocketTimeout("request timed out"))
+
+            except URLError:
+                raise
+
+            except (OSError, ValueError, asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError) as e:
+                raise URLError(e)
+
+            if status >= 400:
+                raise HTTPError(request.url, status, reason, headers, BytesIO(body))
+
+            return request.process_response(status, headers, body)
+
+        async def sleep(delay):
+            await asyncio.sleep(delay)
+            return False
+
+        env_keys, error = await with_retries(request.host, request.url, attempt, sleep)
+        if error is not None:
+            request.report_error(error)
+
+        return env_keys
+
+
+    def submit(self, request):
+        """
+        Schedule the given EnvaultRequest to run on the loop, and return the
+        concurrent future that tracks it; cancelling the future cancels the
+        request.
+        """
+        loop = self._ensure_running()
+        return asyncio.run_coroutine_threadsafe(self._fetch(request), loop)
+
+
+    def stop(self, timeout=1.0):
+        """
+        Stop the loop, cancelling any requests that are still in progress, and
+        wait a short time for the thread to exit.
+        """
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(timeout)
+
+
+## ----------------------------------------------------------------------------
+
+
+# The loop that runs all of the requests made with the asyncio backend.
+_fetch_loop = AsyncFetchLoop()
+
+
+def submit_async_fetch(request):
+    """
+    Schedule a request on the shared asyncio loop; see AsyncFetchLoop.submit().
+    """
+    return _fetch_loop.submit(request)
+
+
+def stop_async_fetches():
+    """
+    Stop the shared asyncio loop; see AsyncFetchLoop.stop().
+    """
+    if ev_settings().debug:
+        log("stopping asyncio fetch loop")
+
+    _fetch_loop.stop()
+
+
+## ----------------------------------------------------------------------------
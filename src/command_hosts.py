@@ -0,0 +1,73 @@
+import sublime
+
+from .settings import ev_settings
+from .logging import log
+from .commands.env_command import host_commands, HOSTS_SETTINGS
+
+
+## ----------------------------------------------------------------------------
+
+
+# The environment commands in each of the plugin hosts; the key is the name
+# that the host uses when it publishes its commands.
+ENV_COMMANDS = {
+    "38": "envault_internal_env_38",
+    "33": "envault_internal_env_33",
+}
+
+# The environment commands to use for a command whose plugin host is not
+# known; the environment is set in both hosts so that it is right no matter
+# which one the command is in.
+ALL_ENV_COMMANDS = tuple(ENV_COMMANDS.values())
+
+# The environment commands to use for each of the commands whose plugin host
+# has been worked out; the key is the name of a command and the value is a
+# tuple of the environment commands for the hosts that the command exists in.
+_command_hosts = { }
+
+
+## ----------------------------------------------------------------------------
+
+
+def _resolve(command):
+    """
+    Work out which plugin hosts the given window command exists in, and
+    return a tuple of the environment commands for them; this is empty if
+    the command can't be found in either host.
+    """
+    found = []
+    if command in host_commands():
+        found.append(ENV_COMMANDS["38"])
+
+    if command in (sublime.load_settings(HOSTS_SETTINGS).get("commands_33") or []):
+        found.append(ENV_COMMANDS["33"])
+
+    return tuple(found)
+
+
+def env_commands_for(command):
+    """
+    Return a tuple of the environment commands that need to be run in order
+    to set the environment for the given window command; this only includes
+    the plugin hosts that the command exists in, if that is known.
+
+    For a build, this is given the target command that the build runs.
+    Commands that can't be found in either host use both, and are looked for
+    again the next time, since the plugin that provides them may not have been
+    loaded yet.
+    """
+    hosts = _command_hosts.get(command)
+    if hosts is None:
+        hosts = _resolve(command)
+        if not hosts:
+            return ALL_ENV_COMMANDS
+
+        if ev_settings().debug:
+            log(f"{command} runs in: {', '.join(hosts)}")
+
+        _command_hosts[command] = hosts
+
+    return hosts
+
+
+## ----------------------------------------------------------------------------
@@ -0,0 +1,72 @@
+import re
+
+from fnmatch import translate
+
+from .logging import log
+
+
+## ----------------------------------------------------------------------------
+
+
+# The prefix that marks an entry in a list of command patterns as a regular
+# expression rather than a command name or glob.
+REGEX_PREFIX = "re:"
+
+# The characters that make an entry in a list of command patterns a glob.
+GLOB_CHARS = frozenset("*?[")
+
+
+## ----------------------------------------------------------------------------
+
+
+class CommandMatcher():
+    """
+    Match command names against a list of patterns, each of which is one of:
+      - the name of a command, which matches only that command
+      - a glob such as "terminus_*", which matches any command that it fits
+      - a regular expression with a "re:" prefix, which matches any command
+        that it matches in full
+
+    All of the names are held in a set and all of the other patterns are
+    combined into a single regular expression, so matching a command costs at
+    most one set lookup and one regular expression match.
+
+    Patterns that are not strings, or that are not valid regular expressions,
+    are logged and ignored.
+    """
+    def __init__(self, patterns):
+        names = []
+        expressions = []
+        for pattern in patterns:
+            if not isinstance(pattern, str):
+                log("ignoring command pattern {0!r}; it is not a string", pattern)
+                continue
+
+            if pattern.startswith(REGEX_PREFIX):
+                expression = pattern[len(REGEX_PREFIX):]
+            elif GLOB_CHARS.intersection(pattern):
+                expression = translate(pattern)
+            else:
+                names.append(pattern)
+                continue
+
+            try:
+                re.compile(expression)
+                expressions.append(f"(?:{expression})")
+            except re.error as e:
+                # Patterns can contain braces, so don't format them into the
+                # message directly.
+                log("ignoring invalid command pattern '{0}': {1}", pattern, e)
+
+        self.names = frozenset(names)
+        self.regex = re.compile("|".join(expressions)) if expressions else None
+
+
+    def __contains__(self, command):
+        if command in self.names:
+            return True
+
+        return self.regex is not None and self.regex.fullmatch(command) is not None
+
+
+## ----------------------------------------------------------------------------
@@ -1,7 +1,8 @@
 from ...envault import reload
 
 reload("src.commands", ["env_command","choose_config", "reload_config",
-                        "create_config", "open_config", "show_variables"])
+                        "create_config", "open_config", "show_variables",
+                        "show_timings"])
 
 from .env_command import EnvaultEnvironmentCommand
 from .choose_config import EnvaultChooseConfigCommand
@@ -9,6 +10,7 @@ from .reload_config import EnvaultReloadConfigCommand
 from .create_config import EnvaultCreateConfigCommand
 from .open_config import EnvaultOpenConfigCommand
 from .show_variables import EnvaultShowVariablesCommand
+from .show_timings import EnvaultShowTimingsCommand
 
 __all__ = [
     # Command that adjusts the environment for us
@@ -21,4 +23,7 @@ __all__ = [
     "EnvaultCreateConfigCommand",
     "EnvaultOpenConfigCommand",
     "EnvaultShowVariablesCommand",
+
+    # Commands that help diagnose the package
+    "EnvaultShowTimingsCommand",
 ]
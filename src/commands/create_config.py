@@ -10,7 +10,7 @@ from ..envault_data import set_envault_config
 from ..config_file import CONFIG_FOLDER, CONFIG_EXTENSION
 from ..config_file import load_and_fetch_config, create_config
 from ..config_status import set_status_config
-from ..settings import ev_setting
+from ..settings import ev_settings
 from ..logging import log
 
 
@@ -190,8 +190,8 @@ class EnvaultCreateConfigCommand(sublime_plugin.WindowCommand):
 
         # Get the values that we need to fill out the template, then create
         # the config.
-        apiKey = ev_setting("default_api_key")
-        url = ev_setting("default_api_url")
+        apiKey = ev_settings().default_api_key
+        url = ev_settings().default_api_url
         create_config(config_name, apiKey, url, self.window)
 
         # If we are supposed to activate the config file, set it into the
@@ -1,8 +1,11 @@
 import sublime
 import sublime_plugin
 
+from collections import namedtuple, deque
 from sys import version_info
 from os import environ
+from threading import Lock
+from time import perf_counter, monotonic
 
 
 ## ----------------------------------------------------------------------------
@@ -12,6 +15,218 @@ from os import environ
 # in; this is used for logging and to help determine the command name
 host = "%d.%d" % (version_info.major, version_info.minor)
 
+# The name of an in memory settings object (it is never saved to disk) that is
+# used by the plugin host that this is bootstrapped into to publish the names
+# of the window commands that it has, so that the other host knows which
+# commands need the environment set in this one.
+HOSTS_SETTINGS = "EnvaultHosts.sublime-settings"
+
+# The number of window commands that existed in this host the last time that
+# they were published.
+published_count = None
+
+# The settings that the environment command uses, as an immutable snapshot
+# that is taken the first time they are needed and again whenever they
+# change. This can't use the settings snapshot of the package, since the
+# bootstrapped copy of this file in the legacy plugin host doesn't have it.
+CommandSettings = namedtuple("CommandSettings", ["debug", "collect_timings"])
+command_settings = None
+
+# The key of the settings listener that keeps the snapshot up to date; this
+# is different in each host.
+COMMAND_SETTINGS_KEY = "envault_env_%s" % (host.replace('.', ''))
+
+# The number of the most recent durations that are kept for each timed phase
+# of handling a command; older ones are dropped as new ones are recorded.
+TIMING_SAMPLES = 512
+
+# The timings of the environment operations in this plugin host, keyed by the
+# name of the operation; the value is a ring buffer of the most recent
+# durations, in seconds. These are only recorded while the collect_timings
+# setting is turned on.
+timings = {}
+
+
+## ----------------------------------------------------------------------------
+
+
+def host_commands():
+    """
+    Return a list of the names of all of the window commands that exist in
+    the plugin host that this is running in.
+    """
+    names = []
+    for cls in sublime_plugin.all_command_classes[1]:
+        try:
+            names.append(cls.name(cls.__new__(cls)))
+        except Exception:
+            pass
+
+    return names
+
+
+def publish_host_commands():
+    """
+    Publish the names of the window commands in this plugin host if the
+    number of them has changed since the last time they were published; this
+    catches commands from plugins that are loaded later on.
+    """
+    global published_count
+
+    count = len(sublime_plugin.all_command_classes[1])
+    if count != published_count:
+        published_count = count
+        settings = sublime.load_settings(HOSTS_SETTINGS)
+        settings.set("commands_%s" % (host.replace('.', '')), host_commands())
+
+
+def load_command_settings():
+    """
+    Take a new snapshot of the settings that the environment command uses.
+    """
+    global command_settings
+
+    s = sublime.load_settings("Envault.sublime-settings")
+    command_settings = CommandSettings(
+        debug=bool(s.get("debug", False)),
+        collect_timings=bool(s.get("collect_timings", False)))
+
+
+def get_command_settings():
+    """
+    Return the snapshot of the settings that the environment command uses;
+    the first call takes the snapshot and adds a listener that takes a new
+    one whenever the settings change.
+    """
+    if command_settings is None:
+        load_command_settings()
+        s = sublime.load_settings("Envault.sublime-settings")
+        s.add_on_change(COMMAND_SETTINGS_KEY, load_command_settings)
+
+    return command_settings
+
+
+def remove_command_settings_listener():
+    """
+    Remove the settings listener added by get_command_settings(), if any.
+    """
+    global command_settings
+
+    if command_settings is not None:
+        s = sublime.load_settings("Envault.sublime-settings")
+        s.clear_on_change(COMMAND_SETTINGS_KEY)
+        command_settings = None
+
+
+def record_timing(operation, start):
+    """
+    Record the time that the given operation has taken since the provided
+    start time. The legacy plugin host is a separate process, so there the
+    timings are also published so that the main plugin host can report them.
+    """
+    samples = timings.get(operation)
+    if samples is None:
+        samples = timings[operation] = deque(maxlen=TIMING_SAMPLES)
+
+    samples.append(perf_counter() - start)
+
+    if host == "3.3":
+        settings = sublime.load_settings(HOSTS_SETTINGS)
+        settings.set("timings_33", dict((k, list(v)) for k, v in timings.items()))
+
+
+def plugin_loaded():
+    """
+    When this is loaded as the bootstrapped plugin in the legacy plugin host,
+    publish the commands that the host has. This is not called in the main
+    plugin host, where this file is a part of the package and not a plugin.
+    """
+    if host == "3.3":
+        sublime.set_timeout(publish_host_commands, 1000)
+
+
+def plugin_unloaded():
+    """
+    When this is unloaded as the bootstrapped plugin in the legacy plugin
+    host, remove the settings listener; the main plugin host does this as a
+    part of unloading the package.
+    """
+    remove_command_settings_listener()
+
+
+## ----------------------------------------------------------------------------
+
+
+class EnvironmentState():
+    """
+    The state of the environment of the plugin host that this runs in.
+
+    Sublime creates a separate instance of a window command for each window,
+    but all of them change the one environment of the plugin host process, so
+    this state is shared by all of them; otherwise one window would not know
+    what another has applied, and could leave its variables behind.
+
+    The environment is set on the main thread but restored in the background,
+    so the state is only ever used with the lock held.
+    """
+    # The number of transitions that will be remembered at once; when this
+    # many are remembered, they are all forgotten before the next one is added.
+    MAX_TRANSITIONS = 32
+
+    # The number of seconds after which a command that the environment was
+    # set for is assumed to have finished without its environment being
+    # restored. The environment is set just before a command runs and
+    # restored as soon as it returns, which is normally well under a second.
+    MAX_FRAME_AGE = 30
+
+    def __init__(self):
+        self.lock = Lock()
+
+        # The environment of the host before anything was applied to it; this
+        # is saved the first time an environment is set.
+        self.original_env = None
+
+        # The prepared changes for each config, keyed by config file; the
+        # value is a tuple of the generation of the environment they were
+        # prepared from and a dict of the variables whose values differ from
+        # the original.
+        self.prepared = {}
+
+        # The prepared changes that are currently applied to the environment,
+        # as a tuple of the (config_file, generation) that they were prepared
+        # for and the changes themselves; None if the environment is the
+        # original one.
+        self.applied = None
+
+        # The differences between pairs of prepared changes, keyed by a tuple
+        # of the (config_file, generation) pairs of the two (None for the
+        # original environment); see transition().
+        self.transitions = {}
+
+        # The stack of commands that the environment is currently set for,
+        # most recent last; each entry is a tuple of the name of the command,
+        # the prepared changes (in the same form as applied) that it needs and
+        # the time that it was set. A command that runs while another one is
+        # still running (such as a watched command that a build triggers) is
+        # pushed on top, and when it finishes the environment goes back to
+        # what the command under it needs.
+        #
+        # If the restore for a command is lost (for example because the
+        # settings changed while it was running, so that it no longer counts
+        # as a watched command), its frame would keep its environment applied
+        # for good; so frames older than MAX_FRAME_AGE are dropped whenever a
+        # command is restored.
+        #
+        # Frames are identified by the name of their command, not by the
+        # individual run of it, since that is all that Sublime tells us when
+        # a command finishes; when the same command is running more than once,
+        # the one that finishes is taken to be the most recent one.
+        self.frames = []
+
+
+# The state of the environment of this plugin host.
+env_state = EnvironmentState()
+
 
 ## ----------------------------------------------------------------------------
 
@@ -24,9 +239,16 @@ class EnvaultEnvironmentCommand(sublime_plugin.WindowCommand):
     The original environment will be saved the first time a set operation is
     executed, to ensure that on systems running MacOS that the environment has
     a chance to be updated by the startup mechanism that launches a terminal.
-    """
-    original_env = None
 
+    The changes that an environment makes to the original environment are
+    worked out once for each generation of the environment of a config, and
+    then re-used by every set operation until the environment changes.
+    Moving from one environment to another only touches the variables that
+    differ between the two.
+
+    What is applied is tracked in env_state, which the commands of all of the
+    windows share; the helper methods here must be called with its lock held.
+    """
     def name(self):
         """
         Override the native handling that names this command so that it
@@ -45,16 +267,18 @@ class EnvaultEnvironmentCommand(sublime_plugin.WindowCommand):
         both hosts and the bootstrapped 3.3 package only gains the command
         and no other support files.
         """
-        s = sublime.load_settings("Envault.sublime-settings")
-        return s.get("debug", False)
+        return get_command_settings().debug
 
 
-    def run(self, command, operation, config_file, env):
+    def run(self, command, operation, config_file, env, generation=None):
         """
         Execute the specified environment operation using the provided args.
         """
+        if host == "3.3":
+            publish_host_commands()
+
         if operation == "set":
-            self.set_env(command, config_file, env)
+            self.set_env(command, config_file, env, generation)
 
         elif operation == "restore":
             self.restore_env(command)
@@ -63,29 +287,25 @@ class EnvaultEnvironmentCommand(sublime_plugin.WindowCommand):
             print("Envault: unknown env operation '%s' in %s" % (operation, host))
 
 
-    def set_env(self, command, config_file, env):
+    def prepare_env(self, config_file, env, generation):
         """
-        Set the environment for the plugin host by extending the currently
-        available environment with the keys from the provided dictionary.
+        Return the changes that need to be made to the original environment
+        of the host in order to apply the provided environment, as a dict of
+        the variables whose values need to change.
 
-        This will also lazily save the current environment if it has not
-        previously been saved.
+        The result is kept and returned again for the same config for as long
+        as the generation of its environment stays the same; if there is no
+        generation, the changes are always worked out again.
         """
-        if self.original_env is None:
-            self.original_env = environ.copy()
+        cached = env_state.prepared.get(config_file)
+        if generation is not None and cached is not None and cached[0] == generation:
+            return cached[1]
 
         if self.debugging():
-            print("Envault: setting environment variables in %s for %s" % (host, command))
+            print("Envault: preparing environment in %s for %s" % (host, config_file))
 
-        # It is possible that we might get triggered to set the environment
-        # while the environment is currently set, such as when a build triggers
-        # a target that itself triggers a command that is in the user's watch
-        # list.
-        #
-        # In order to ensure that we don't leak any environment, create a fresh
-        # copy of the original environment of the host, update it with the
-        # passed in environment, and then apply that environment.
-        new_env = self.original_env.copy()
+        original_env = env_state.original_env
+        new_env = original_env.copy()
         new_env.update(env)
 
         # Set up some environment values to be included in the new environment
@@ -104,18 +324,140 @@ class EnvaultEnvironmentCommand(sublime_plugin.WindowCommand):
             if var not in env:
                 new_env[var] = value
 
-        # Apply the new environment now
-        environ.clear()
-        environ.update(new_env)
+        changes = dict((var, value) for var, value in new_env.items()
+                       if original_env.get(var) != value)
+
+        if generation is not None:
+            env_state.prepared[config_file] = (generation, changes)
+
+        return changes
+
+
+    def transition(self, target):
+        """
+        Given the prepared changes to apply (in the same form as the applied
+        attribute of env_state), return a tuple of the variables that need to
+        be given new values and the list of variables that need to be put back
+        to their original values, in order to move from the changes that are
+        applied now to the target changes.
+
+        The result is remembered for each pair of config generations, since
+        the same few transitions tend to happen over and over.
+        """
+        transitions = env_state.transitions
+        current = env_state.applied or (None, {})
+        target = target or (None, {})
+
+        # Changes without a generation can't be identified, so they can't be
+        # remembered either.
+        key = (current[0], target[0])
+        cachable = all(k is None or k[1] is not None for k in key)
+
+        if cachable and key in transitions:
+            return transitions[key]
+
+        updates = dict((var, value) for var, value in target[1].items()
+                       if current[1].get(var) != value)
+        reverts = [var for var in current[1] if var not in target[1]]
+
+        if cachable:
+            if len(transitions) >= env_state.MAX_TRANSITIONS:
+                transitions.clear()
+            transitions[key] = (updates, reverts)
+
+        return updates, reverts
+
+
+    def is_applied(self, target):
+        """
+        Given prepared changes (in the same form as the applied attribute of
+        env_state), return an indication of whether they are known to be the
+        ones that are currently applied; changes without a generation never
+        are.
+        """
+        applied = env_state.applied
+        if target is None or applied is None:
+            return target is applied
+
+        return target[0][1] is not None and target[0] == applied[0]
+
+
+    def apply_changes(self, target):
+        """
+        Given the prepared changes to apply (in the same form as the applied
+        attribute of env_state), update the environment so that exactly those
+        changes are applied, touching only the variables that need to change.
+        """
+        updates, reverts = self.transition(target)
+
+        original_env = env_state.original_env
+        for var in reverts:
+            if var in original_env:
+                environ[var] = original_env[var]
+            else:
+                environ.pop(var, None)
+
+        for var, value in updates.items():
+            environ[var] = value
+
+        env_state.applied = target
+
+
+    def set_env(self, command, config_file, env, generation=None):
+        """
+        Set the environment for the plugin host by extending the currently
+        available environment with the keys from the provided dictionary.
+
+        This will also lazily save the current environment if it has not
+        previously been saved.
+        """
+        if self.debugging():
+            print("Envault: setting environment variables in %s for %s" % (host, command))
+
+        start = perf_counter()
+        with env_state.lock:
+            if env_state.original_env is None:
+                env_state.original_env = environ.copy()
+
+            changes = self.prepare_env(config_file, env, generation)
+
+            # It is possible that we might get triggered to set the environment
+            # while the environment is currently set, such as when a build
+            # triggers a target that itself triggers a command that is in the
+            # user's watch list, or when a build starts in another window.
+            #
+            # If that is for the same generation of the same config, there is
+            # nothing to change; otherwise, in order to ensure that we don't
+            # leak any environment, any changes that are currently applied and
+            # not part of the new ones are undone.
+            target = ((config_file, generation), changes)
+            env_state.frames.append((command, target, monotonic()))
+            if not self.is_applied(target):
+                self.apply_changes(target)
+
+        if get_command_settings().collect_timings:
+            record_timing("set_env", start)
 
 
     def restore_env(self, command):
         """
         Restore the environment that was previously in effect prior to the
-        last call to set_env().
+        call to set_env() for the given command.
+
+        This removes the command from the stack of commands that need the
+        environment set; the environment then goes back to what the command
+        that is now on top of the stack needs, or to the original environment
+        if it is empty.
+
+        The environment is changed in the background; by the time that
+        happens another command may have set it again, so what is applied is
+        decided then, based on the stack at that point. Since that happens
+        with the lock held, a restore can't undo a set that it races with.
 
-        This will restore the environment to the environment that was set as
-        a part of that call.
+        Only the command name is known, so if that command is on the stack
+        more than once, its most recent frame is the one that is removed.
+        Frames for commands that were set too long ago to still be running
+        are removed as well.
 
         If the environment was not previously saved, then this will do nothing.
         """
@@ -123,14 +465,45 @@ class EnvaultEnvironmentCommand(sublime_plugin.WindowCommand):
             print("Envault: removing environment variables in %s after %s" % (host, command))
 
         def restore():
-            environ.clear()
-            environ.update(self.original_env)
-
-        if self.original_env is not None:
-            sublime.set_timeout_async(lambda: restore())
-        else:
-            print("Envault: attempt to restore environment before it was saved")
+            start = perf_counter()
+            with env_state.lock:
+                frames = env_state.frames
+                target = frames[-1][1] if frames else None
+                if not self.is_applied(target):
+                    self.apply_changes(target)
+
+            if get_command_settings().collect_timings:
+                record_timing("restore_env", start)
+
+        with env_state.lock:
+            if env_state.original_env is None:
+                return print("Envault: attempt to restore environment before it was saved")
+
+            # Remove the most recent frame for this command; it should be on
+            # top, but commands do not always finish in the order they started.
+            frames = env_state.frames
+            found = False
+            for index in range(len(frames) - 1, -1, -1):
+                if frames[index][0] == command:
+                    del frames[index]
+                    found = True
+                    break
+
+            # Drop the frames of commands whose restore was lost.
+            now = monotonic()
+            live = [f for f in frames if now - f[2] <= env_state.MAX_FRAME_AGE]
+            dropped = len(live) != len(frames)
+            if dropped:
+                print("Envault: dropping stale environment in %s for %s" %
+                      (host, ", ".join(f[0] for f in frames if f not in live)))
+                frames[:] = live
+
+            if not found:
+                print("Envault: attempt to restore environment for %s before it was set" % command)
+                if not dropped:
+                    return
+
+        sublime.set_timeout_async(lambda: restore())
 
 
 ## ----------------------------------------------------------------------------
-
@@ -20,10 +20,11 @@ class EnvaultReloadConfigCommand(sublime_plugin.WindowCommand):
     """
     def run(self):
         # Get the current configuration file that's in use in the window, and
-        # reload it
+        # reload it; this is an explicit request for fresh values, so nothing
+        # is taken from the spec cache.
         config = get_envault_config(self.window)
         log(f"reloading envault config {config}")
-        load_and_fetch_config(config)
+        load_and_fetch_config(config, force=True)
 
 
     def is_enabled(self):
@@ -0,0 +1,34 @@
+import sublime
+import sublime_plugin
+
+from ..logging import log
+
+from ..timings import timing_summary
+
+## ----------------------------------------------------------------------------
+
+
+class EnvaultShowTimingsCommand(sublime_plugin.WindowCommand):
+    """
+    Show a quick panel that displays how long each phase of setting and
+    restoring the environment around commands has been taking, as the number
+    of times that it was timed and the 50th, 95th and 99th percentile of the
+    most recent durations.
+
+    Timings are only collected while the collect_timings setting is turned
+    on.
+    """
+    def run(self):
+        summary = timing_summary()
+        if not summary:
+            return log(f"no timings collected; turn on the collect_timings setting", status=True)
+
+        items = [[phase, f"count {count}  p50 {p50 * 1000:.3f}ms  "
+                         f"p95 {p95 * 1000:.3f}ms  p99 {p99 * 1000:.3f}ms"]
+                 for phase, count, p50, p95, p99 in summary]
+
+        self.window.show_quick_panel(items, on_select=lambda idx: None,
+            placeholder='Envault build hook timings')
+
+
+## ----------------------------------------------------------------------------
@@ -10,10 +10,12 @@ from .logging import log
 from ..yaml import safe_load
 from ..yaml.scanner import ScannerError
 
-from .env_cache import store_env
-from .envault_request import EnvaultRequestThread
+from .env_cache import store_env, has_env, note_failed_fetch
+from .disk_cache import persist_env
+from .fetch_registry import request_digest, begin_fetch, end_fetch
+from .fetch_batcher import schedule_fetch
 
-from .settings import ev_setting
+from .settings import ev_settings
 
 
 ## ----------------------------------------------------------------------------
@@ -114,7 +116,7 @@ def load_if_exists(config_file):
 ## ----------------------------------------------------------------------------
 
 
-def _accept_loaded_config(var_list, config_file):
+def _accept_loaded_config(var_list, config_file, apiKeyName, generation):
     """
     Invoked after a call to load_and_fetch_config() to accept the loaded config
     data, if any.
@@ -122,27 +124,50 @@ def _accept_loaded_config(var_list, config_file):
     This will update the environment cache associated with the result, either
     storing in a new config or clobbering one that might have already existed
     from a previous call, depending on whether or not it worked.
+
+    If a newer fetch for the same config was started while this one was in
+    progress, the result is stale and is thrown away without touching the
+    cache.
+
+    A failed request does not replace an environment that was previously
+    fetched for the config; the last known good environment is kept. A
+    successful one is also persisted to the on disk cache (if enabled),
+    protected by the API key named by apiKeyName.
     """
+    waiters = end_fetch(config_file, generation)
+    if waiters is None:
+        return
+
     if var_list is None:
+        note_failed_fetch(config_file)
+
+    if var_list is None and has_env(config_file):
+        log("request failed; keeping the last known good environment")
+
+    elif var_list is None:
         log("no variables to set; request failed")
         # If a request failed, update the cache to not have any values, but
         # keep a record of this config still being active. This allows the
         # post-save event listener to tell that this config is still active,
         # so that fixing it if you break it will allow it to reload.
-        store_env(config_file, {})
-        return
+        store_env(config_file, {}, fetched=False)
 
-    log(f"loaded envault config from {split(config_file)[1]}", status=True)
-    if ev_setting("debug"):
-        log(f"variables: {list(var_list.keys())}")
+    else:
+        log(f"loaded envault config from {split(config_file)[1]}", status=True)
+        if ev_settings().debug:
+            log(f"variables: {list(var_list.keys())}")
 
-    store_env(config_file, var_list)
+        store_env(config_file, var_list)
+        persist_env(config_file, apiKeyName, var_list)
+
+    for callback in waiters:
+        callback(config_file)
 
 
 ## ----------------------------------------------------------------------------
 
 
-def load_and_fetch_config(config_file):
+def load_and_fetch_config(config_file, callback=None, force=False):
     """
     Given an envault configuration filenam that we presume exists, load the
     config and then invoke a request to the server to fetch the variables that
@@ -153,18 +178,39 @@ def load_and_fetch_config(config_file):
 
     Sucessful loads from the server will update the cache; request failures
     will get logged as well.
+
+    If an identical request for this config is already in progress, no new
+    request is made; the call attaches to the one that is running instead. In
+    either case the optional callback is invoked with the name of the config
+    file once the cache has been updated.
+
+    Variables for specs that were recently fetched for another config are
+    taken from the spec cache rather than being requested again, unless force
+    is True.
     """
     config = load_if_exists(config_file)
     if not config:
+        note_failed_fetch(config_file)
         return log("""
             Error loading the Envault config file; see the
             console for error details.
             """, error=True)
 
-    # Kick off a background request to fetch the actual environment keys
-    # that are being requested by this config.
-    EnvaultRequestThread(**config, config_file=config_file, callback=
-                         lambda r: _accept_loaded_config(r, config_file)).start()
+    # Register the fetch; if the same request is already running, there is
+    # nothing else to do since its result is the one we would get anyway.
+    flight = begin_fetch(config_file, request_digest(config), callback)
+    if flight is None:
+        return
+
+    generation, token = flight
+
+    # Schedule a background request to fetch the actual environment keys
+    # that are being requested by this config; this may be combined with the
+    # requests for other configs that use the same server.
+    apiKeyName = config["apiKeyName"]
+    schedule_fetch(config_file, config,
+                   lambda r: _accept_loaded_config(r, config_file, apiKeyName, generation),
+                   token, force)
 
 
 ## ----------------------------------------------------------------------------
@@ -3,7 +3,7 @@ import sublime
 from os.path import split, splitext
 from os import sep
 
-from .settings import ev_setting
+from .settings import ev_settings
 
 
 ## ----------------------------------------------------------------------------
@@ -91,7 +91,7 @@ def set_status_config(file, view_or_window):
     If the config file provided is the empty string, the status key is removed
     instead of being added.
     """
-    template_string = ev_setting("status_bar_format")
+    template_string = ev_settings().status_bar_format
 
     # Erase keys if the incoming configuration file name is not provided, or if
     # the template string indicates that the user does not want to see any
@@ -0,0 +1,380 @@
+import http.client
+import socket
+
+from .settings import ev_settings
+from .logging import log
+from .ssl_context import get_ssl_context, ResumingHTTPSConnection
+from .content_encoding import ContentDecoder
+from .resilience import FetchCancelledError
+
+from collections import namedtuple
+
+from base64 import b64encode
+
+from io import BytesIO
+
+from threading import Lock
+from time import monotonic
+
+from urllib.error import URLError, HTTPError
+from urllib.parse import urlparse, urldefrag, unquote
+from urllib.request import getproxies, proxy_bypass
+
+
+## ----------------------------------------------------------------------------
+
+
+# The size of the pieces that the body of a response is read in.
+READ_CHUNK_SIZE = 64 * 1024
+
+# The result of a request made through the connection pool; the body is the
+# complete (decoded) payload of the response, since the connection has to be
+# fully drained before it can be handed back to the pool for re-use.
+PooledResponse = namedtuple("PooledResponse", ["status", "reason", "headers", "body"])
+
+# The proxy that a request has to be made through; headers is a tuple of the
+# (name, value) pairs of the headers to send to the proxy, which carry its
+# credentials if it needs them.
+Proxy = namedtuple("Proxy", ["host", "port", "headers"])
+
+# The errors that indicate that a connection that was sitting idle in the pool
+# was closed by the remote end while it was not in use; these are retried once
+# on a fresh connection, since the request never made it to the server.
+_STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+
+## ----------------------------------------------------------------------------
+
+
+class ConnectionPool():
+    """
+    A process wide pool of keep-alive HTTP connections, keyed by the scheme,
+    host and port of the server that they connect to.
+
+    Connections are taken out of the pool while a request is in progress on
+    them, so each connection is only ever used by one thread at a time, and
+    are put back once the response has been fully read, so that the next
+    request to the same server can skip the TCP and TLS handshakes.
+
+    Connections that sit idle for longer than the configured timeout are
+    closed, and the total number of idle connections is capped; when the cap
+    is reached, the connection that has been idle the longest is dropped.
+
+    Requests go through the proxy from the environment (see proxy_for()) if
+    there is one, as they did with urlopen(); connections through a proxy are
+    pooled separately from direct ones.
+    """
+    def __init__(self):
+        self._lock = Lock()
+
+        # The key is a (scheme, host, port, proxy) tuple; the value is a list
+        # of (connection, idle_since) tuples, oldest first.
+        self._idle = {}
+
+
+    def _new_connection(self, scheme, host, port, timeout, proxy=None):
+        """
+        Create and return a brand new connection to the given server, or to
+        the proxy for it if one is given; HTTPS connections are tunneled
+        through the proxy.
+        """
+        if proxy is None:
+            if scheme == "https":
+                return ResumingHTTPSConnection(host, port, timeout=timeout,
+                                               context=get_ssl_context())
+
+            return http.client.HTTPConnection(host, port, timeout=timeout)
+
+        if scheme == "https":
+            conn = ResumingHTTPSConnection(proxy.host, proxy.port, timeout=timeout,
+                                           context=get_ssl_context())
+            conn.set_tunnel(host, port, dict(proxy.headers))
+            return conn
+
+        return http.client.HTTPConnection(proxy.host, proxy.port, timeout=timeout)
+
+
+    def _evict_idle(self, now):
+        """
+        Close and remove all connections that have been idle for longer than
+        the configured idle timeout. This must be called with the lock held.
+        """
+        max_idle = ev_settings().connection_idle_timeout
+        for key in list(self._idle.keys()):
+            keep = []
+            for conn, idle_since in self._idle[key]:
+                if now - idle_since > max_idle:
+                    conn.close()
+                else:
+                    keep.append((conn, idle_since))
+
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+
+
+    def _evict_oldest(self):
+        """
+        Close and remove the single connection that has been idle for the
+        longest amount of time. This must be called with the lock held.
+        """
+        oldest = min(self._idle.keys(), key=lambda k: self._idle[k][0][1])
+        conn, _ = self._idle[oldest].pop(0)
+        if not self._idle[oldest]:
+            del self._idle[oldest]
+
+        conn.close()
+
+
+    def acquire(self, scheme, host, port, timeout=None, proxy=None):
+        """
+        Get a connection to the given server (through the given proxy, if
+        any), re-using an idle one if there is one available. The return value
+        is a tuple of the connection and a boolean that indicates if the
+        connection was re-used or not.
+
+        The timeout is used when a new connection has to be made.
+        """
+        key = (scheme, host, port, proxy)
+        context = get_ssl_context() if scheme == "https" else None
+        with self._lock:
+            self._evict_idle(monotonic())
+
+            # If the SSL context was rebuilt because the settings changed, any
+            # idle connections that were made with the old one are stale.
+            idle = self._idle.pop(key, [])
+            while idle and context is not None and idle[-1][0]._context is not context:
+                idle.pop()[0].close()
+
+            # Use the most recently released connection, since it is the least
+            # likely to have been closed by the server.
+            conn = idle.pop()[0] if idle else None
+            if idle:
+                self._idle[key] = idle
+
+            if conn is not None:
+                return conn, True
+
+        return self._new_connection(scheme, host, port, timeout, proxy), False
+
+
+    def release(self, scheme, host, port, conn, proxy=None):
+        """
+        Return a connection whose response has been fully read back to the
+        pool so that it can be re-used by a later request.
+        """
+        key = (scheme, host, port, proxy)
+        with self._lock:
+            now = monotonic()
+            self._evict_idle(now)
+
+            max_size = ev_settings().connection_pool_size
+            if max_size <= 0:
+                return conn.close()
+
+            while sum(len(v) for v in self._idle.values()) >= max_size:
+                self._evict_oldest()
+
+            self._idle.setdefault(key, []).append((conn, now))
+
+
+    def close_all(self):
+        """
+        Close every idle connection in the pool and empty it.
+        """
+        with self._lock:
+            for connections in self._idle.values():
+                for conn, _ in connections:
+                    conn.close()
+
+            self._idle = {}
+
+
+    def request(self, method, url, body=None, headers=None,
+                connect_timeout=None, read_timeout=None, token=None):
+        """
+        Make a request to the given URL over a pooled connection, and return
+        a PooledResponse with the results. The body of the response is decoded
+        as it is read, according to its Content-Encoding.
+
+        Making a new connection is limited by connect_timeout, and each read
+        from the connection by read_timeout. If a CancelToken is provided,
+        cancelling it aborts the request by shutting down its socket.
+
+        This mimics the error handling of urlopen(); an HTTPError is raised
+        for responses with an error status, and a URLError is raised if the
+        request could not be made at all.
+        """
+        scheme, host, port, target = request_target(url)
+
+        # A plain HTTP request through a proxy is sent to the proxy with the
+        # whole URL as its target; HTTPS requests are tunneled instead.
+        proxy = proxy_for(url)
+        if proxy is not None and scheme == "http":
+            target = urldefrag(url)[0]
+            headers = dict(headers or {}, **dict(proxy.headers))
+
+        while True:
+            if token is not None and token.cancelled:
+                raise FetchCancelledError("request was cancelled")
+
+            conn, reused = self.acquire(scheme, host, port, connect_timeout, proxy)
+            abort = lambda: _abort_connection(conn)
+            if token is not None:
+                token.attach(abort)
+
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                conn.sock.settimeout(read_timeout)
+
+                conn.request(method, target, body, headers or {})
+                res = conn.getresponse()
+                if isinstance(conn, ResumingHTTPSConnection):
+                    conn.save_session()
+
+                decoder = ContentDecoder(res.headers.get("Content-Encoding"))
+                while True:
+                    chunk = res.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    decoder.feed(chunk)
+
+                payload = decoder.finish()
+                break
+
+            except _STALE_CONNECTION_ERRORS as e:
+                conn.close()
+                if token is not None and token.cancelled:
+                    raise FetchCancelledError("request was cancelled")
+
+                if not reused:
+                    raise URLError(e)
+
+                if ev_settings().debug:
+                    log(f"pooled connection to {host}:{port} went stale; reconnecting")
+
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                conn.close()
+                if token is not None and token.cancelled:
+                    raise FetchCancelledError("request was cancelled")
+
+                raise URLError(e)
+
+            finally:
+                if token is not None:
+                    token.detach(abort)
+
+        # A connection can only be put back into the pool if the server has
+        # not indicated that it is going to close it.
+        if res.will_close:
+            conn.close()
+        else:
+            self.release(scheme, host, port, conn, proxy)
+
+        if res.status >= 400:
+            raise HTTPError(url, res.status, res.reason, res.headers, BytesIO(payload))
+
+        return PooledResponse(res.status, res.reason, res.headers, payload)
+
+
+## ----------------------------------------------------------------------------
+
+
+def request_target(url):
+    """
+    Given the URL of a request, return a tuple of the scheme, host and port of
+    the server to connect to and the target (path, params and query) to put in
+    the request line.
+    """
+    parsed = urlparse(url)
+    scheme = parsed.scheme
+    port = parsed.port or (443 if scheme == "https" else 80)
+
+    target = parsed.path or "/"
+    if parsed.params:
+        target = f"{target};{parsed.params}"
+    if parsed.query:
+        target = f"{target}?{parsed.query}"
+
+    return scheme, parsed.hostname, port, target
+
+
+def proxy_for(url):
+    """
+    Return the Proxy that a request to the given URL has to be made through,
+    or None if it should be made directly.
+
+    This follows the standard proxy environment variables (such as
+    HTTPS_PROXY and NO_PROXY) in the same way as urlopen() does; credentials
+    in the URL of the proxy are sent to it with basic authentication.
+    """
+    parsed = urlparse(url)
+    proxy_url = getproxies().get(parsed.scheme)
+    if not proxy_url:
+        return None
+
+    netloc = parsed.hostname if parsed.port is None else f"{parsed.hostname}:{parsed.port}"
+    if proxy_bypass(netloc):
+        return None
+
+    if "://" not in proxy_url:
+        proxy_url = f"http://{proxy_url}"
+
+    proxy = urlparse(proxy_url)
+    headers = ()
+    if proxy.username is not None:
+        credentials = f"{unquote(proxy.username)}:{unquote(proxy.password or '')}"
+        headers = (("Proxy-Authorization",
+                    "Basic " + b64encode(credentials.encode("utf-8")).decode("ascii")),)
+
+    return Proxy(proxy.hostname, proxy.port or (443 if proxy.scheme == "https" else 80),
+                 headers)
+
+
+def _abort_connection(conn):
+    """
+    Abort the request in progress on the given connection from another thread
+    by shutting down its socket; this wakes up a thread that is blocked reading
+    from it, which closing it would not reliably do.
+    """
+    sock = conn.sock
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+## ----------------------------------------------------------------------------
+
+
+# The pool that is shared by all requests made by the package.
+_pool = ConnectionPool()
+
+
+def pooled_request(method, url, body=None, headers=None,
+                   connect_timeout=None, read_timeout=None, token=None):
+    """
+    Make a request using the shared connection pool; see the request() method
+    of ConnectionPool for more details.
+    """
+    return _pool.request(method, url, body, headers,
+                         connect_timeout, read_timeout, token)
+
+
+def close_connections():
+    """
+    Close all of the idle connections that are currently held in the shared
+    connection pool.
+    """
+    _pool.close_all()
+
+
+## ----------------------------------------------------------------------------
@@ -0,0 +1,105 @@
+import zlib
+
+from .settings import ev_settings
+
+# Brotli is not a part of the standard library, so it is only offered to the
+# server if a module that provides it is available.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+## ----------------------------------------------------------------------------
+
+
+def accept_encoding():
+    """
+    Return the value of the Accept-Encoding header to send with requests,
+    which lists all of the content encodings that we can decode.
+    """
+    return "gzip, deflate, br" if brotli is not None else "gzip, deflate"
+
+
+## ----------------------------------------------------------------------------
+
+
+class ContentDecoder():
+    """
+    Decode the body of a response as it is read, based on the Content-Encoding
+    that the server used.
+
+    Chunks of the raw body are given to feed() as they arrive, and finish()
+    returns the complete decoded body. The size of the decoded body is capped
+    by the max_response_size setting, so that a small compressed response
+    can't expand to fill all available memory; exceeding the cap raises a
+    ValueError.
+    """
+    def __init__(self, encoding):
+        self.encoding = (encoding or "identity").strip().lower()
+        self.max_size = ev_settings().max_response_size
+
+        self._chunks = []
+        self._size = 0
+
+        if self.encoding == "gzip":
+            self._decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == "deflate":
+            # Servers are supposed to send zlib wrapped data, but some send a
+            # raw deflate stream; which one this is will be known once the
+            # first chunk arrives.
+            self._decomp = zlib.decompressobj(zlib.MAX_WBITS)
+            self._first = True
+        elif self.encoding == "br" and brotli is not None:
+            self._decomp = brotli.Decompressor()
+        elif self.encoding == "identity":
+            self._decomp = None
+        else:
+            raise ValueError(f"unsupported content encoding '{self.encoding}'")
+
+
+    def _append(self, data):
+        """
+        Add decoded data to the body, enforcing the size limit.
+        """
+        self._size += len(data)
+        if self._size > self.max_size:
+            raise ValueError(f"response exceeds {self.max_size} bytes")
+
+        self._chunks.append(data)
+
+
+    def feed(self, chunk):
+        """
+        Decode the next chunk of the raw body.
+        """
+        if self._decomp is None:
+            return self._append(chunk)
+
+        if self.encoding == "br":
+            return self._append(self._decomp.process(chunk))
+
+        if self.encoding == "deflate" and self._first:
+            self._first = False
+            try:
+                return self.feed(chunk)
+            except zlib.error:
+                self._decomp = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        # Ask for at most one byte more than the cap allows, so that a body
+        # that is too large is caught without decompressing all of it.
+        data = self._decomp.decompress(chunk, self.max_size - self._size + 1)
+        self._append(data)
+
+
+    def finish(self):
+        """
+        Return the complete decoded body.
+        """
+        if self._decomp is not None and self.encoding != "br":
+            self._append(self._decomp.flush())
+
+        return b"".join(self._chunks)
+
+
+## ----------------------------------------------------------------------------
@@ -4,7 +4,15 @@ from ..lib.bootstrap import bootstrap_legacy_package
 
 from .config_file import load_and_fetch_config
 from .config_status import set_status_config
+from .connection_pool import close_connections
+from .fetch_executor import shutdown_fetches
+from .async_fetch import stop_async_fetches
+from .ssl_context import clear_ssl_context
+from .disk_cache import restore_envs, flush_disk_cache
+from .env_cache import store_restored_envs
 from .envault_data import get_envault_config
+from .settings import reload_settings, SETTINGS_FILE
+from .commands.env_command import remove_command_settings_listener
 from .logging import log
 
 
@@ -52,11 +60,21 @@ def add_settings_listener():
 
     When settings change, we re-scan the window configurations to ensure that
     if the user modified the format string for the status message, that all of
-    the windows update with it.
+    the windows update with it, and take a new snapshot of the settings.
     """
     log("adding settings listener")
-    settings = sublime.load_settings("Envault.sublime-settings")
-    settings.add_on_change(ENVAULT_SETTINGS_KEY, scan_window_configs)
+    settings = sublime.load_settings(SETTINGS_FILE)
+    settings.add_on_change(ENVAULT_SETTINGS_KEY, settings_changed)
+
+
+def settings_changed():
+    """
+    Invoked whenever the settings for the package change; this takes a new
+    snapshot of the settings before doing anything else, so that everything
+    sees the new values.
+    """
+    reload_settings()
+    scan_window_configs()
 
 
 def remove_settings_listener():
@@ -66,8 +84,9 @@ def remove_settings_listener():
     will cause each change to be handled multiple times.
     """
     log("removing settings listener")
-    settings = sublime.load_settings("Envault.sublime-settings")
+    settings = sublime.load_settings(SETTINGS_FILE)
     settings.clear_on_change(ENVAULT_SETTINGS_KEY)
+    remove_command_settings_listener()
 
 
 ## ----------------------------------------------------------------------------
@@ -81,18 +100,32 @@ def loaded():
     3.3 plugin host so that we can support build targets from both versions of
     Sublime the same, and ensure that any restored windows that had envault
     configs have that config loaded.
+
+    If the persistent cache is turned on, the environments from the last
+    session are restored in the background, so that they can be used while
+    the startup fetches are still in progress.
     """
     log("initializing")
     add_settings_listener()
     bootstrap_legacy_package()
+    restore_envs(store_restored_envs)
     scan_window_configs(fetch=True)
 
 
 def unloaded():
     """
-    Invoked when the root plugin is unloaded.
+    Invoked when the root plugin is unloaded; this removes our settings
+    listener, stops the fetch workers and the asyncio fetch loop and closes
+    any connections that are being held open in the connection pool. Any
+    changes to the persistent cache that have not been written yet are
+    written out.
     """
     remove_settings_listener()
+    flush_disk_cache()
+    shutdown_fetches()
+    stop_async_fetches()
+    close_connections()
+    clear_ssl_context()
 
 
 ## ----------------------------------------------------------------------------
@@ -0,0 +1,370 @@
+import sublime
+
+from .settings import ev_settings
+from .logging import log
+
+from base64 import b64encode, b64decode
+
+from collections import OrderedDict
+
+from hashlib import pbkdf2_hmac, sha256
+from hmac import new as hmac_new, compare_digest
+
+from json import dumps, loads
+
+from os import environ, makedirs, replace, urandom
+from os.path import join, exists
+
+from threading import Lock
+
+from time import time
+
+
+## ----------------------------------------------------------------------------
+
+
+# The name of the file in the Envault folder of the Sublime cache directory
+# that holds the persisted environments.
+CACHE_FILE = "environments.json"
+
+# The number of milliseconds that changes to the persisted environments are
+# held before they are written out, so that a burst of fetches (such as at
+# startup) results in a single write of the file.
+WRITE_DELAY = 1000
+
+# The number of PBKDF2 iterations used to derive the keys for an entry from
+# the API key that protects it.
+KDF_ITERATIONS = 100000
+
+# The number of sets of derived keys that are remembered; there is usually
+# one for each config that is persisted.
+DERIVED_KEYS_SIZE = 32
+
+
+## ----------------------------------------------------------------------------
+
+
+# The entries of the cache file, exactly as they are stored on disk (that is,
+# still encrypted); the key is the fully qualified and absolute filename of an
+# Envault config, and the value is a dict that describes the entry. This is
+# None until the file has been read.
+_entries = None
+
+# The entries that are waiting to be written to disk, already encrypted; the
+# key is the config file, and the value is the new entry, or None if the entry
+# should be removed.
+_pending = { }
+_write_scheduled = False
+
+# The keys derived for each API key and salt, since deriving them is
+# purposefully slow; the key is an HMAC of the API key using the salt, so that
+# the values of API keys are not held here, and the least recently used keys
+# are dropped first.
+_derived_keys = OrderedDict()
+
+# Protects all of the above, which are used from both the main thread and the
+# async thread.
+_lock = Lock()
+
+
+## ----------------------------------------------------------------------------
+
+
+def _cache_file():
+    """
+    Return the full path to the file that holds the persisted environments.
+    """
+    return join(sublime.cache_path(), "Envault", CACHE_FILE)
+
+
+def _derive_keys(secret, salt):
+    """
+    Given the value of an API key and a salt, return a tuple of the key used
+    to encrypt an entry and the key used to authenticate it.
+
+    This is slow, so it should not be called on the main thread; it must not
+    be called with the lock held.
+    """
+    cache_key = hmac_new(salt, secret.encode("utf-8"), sha256).digest()
+    with _lock:
+        keys = _derived_keys.get(cache_key)
+        if keys is not None:
+            _derived_keys.move_to_end(cache_key)
+            return keys
+
+    derived = pbkdf2_hmac("sha256", secret.encode("utf-8"), salt,
+                          KDF_ITERATIONS, 64)
+    keys = (derived[:32], derived[32:])
+
+    with _lock:
+        _derived_keys[cache_key] = keys
+        while len(_derived_keys) > DERIVED_KEYS_SIZE:
+            _derived_keys.popitem(last=False)
+
+    return keys
+
+
+def _keystream_xor(key, nonce, data):
+    """
+    Encrypt or decrypt the given data by combining it with a keystream made
+    of HMAC-SHA256 blocks over the nonce and a block counter.
+    """
+    # Each block is the HMAC of the nonce followed by the counter; copying an
+    # HMAC that has already seen the nonce is much cheaper than starting over.
+    base = hmac_new(key, nonce, sha256)
+
+    def block(offset):
+        mac = base.copy()
+        mac.update(offset.to_bytes(8, "big"))
+        return mac.digest()
+
+    stream = b"".join(block(offset) for offset in range(0, len(data), 32))
+
+    # XOR everything at once as a pair of large integers, which is far faster
+    # than combining the data one byte at a time.
+    mixed = int.from_bytes(data, "big") ^ int.from_bytes(stream[:len(data)], "big")
+    return mixed.to_bytes(len(data), "big")
+
+
+def _tag(key, config_file, salt, nonce, ciphertext):
+    """
+    Return the authentication tag for an entry; this covers the config file
+    too, so that an entry can't be moved over to another config.
+    """
+    mac = hmac_new(key, config_file.encode("utf-8"), sha256)
+    for part in (salt, nonce, ciphertext):
+        mac.update(part)
+
+    return mac.digest()
+
+
+## ----------------------------------------------------------------------------
+
+
+def _encrypt(config_file, apiKeyName, env, salt):
+    """
+    Return the cache entry for the given environment, encrypted with the API
+    key that the config uses, or None if that API key is not set.
+    """
+    secret = environ.get(apiKeyName)
+    if not secret:
+        return None
+
+    enc_key, mac_key = _derive_keys(secret, salt)
+    nonce = urandom(16)
+    ciphertext = _keystream_xor(enc_key, nonce, dumps(dict(env)).encode("utf-8"))
+
+    return {
+        "apiKeyName": apiKeyName,
+        "stored": time(),
+        "salt": b64encode(salt).decode("ascii"),
+        "nonce": b64encode(nonce).decode("ascii"),
+        "data": b64encode(ciphertext).decode("ascii"),
+        "tag": b64encode(_tag(mac_key, config_file, salt, nonce, ciphertext)).decode("ascii")
+    }
+
+
+def _decrypt(config_file, entry):
+    """
+    Return the environment held in the given cache entry, or None if it can't
+    be decrypted with the API key it was stored with; this is the case if the
+    key is no longer set or has been changed, or if the entry was tampered
+    with.
+    """
+    secret = environ.get(entry["apiKeyName"])
+    if not secret:
+        return None
+
+    salt, nonce, ciphertext, tag = (b64decode(entry[k]) for k in
+                                    ("salt", "nonce", "data", "tag"))
+
+    enc_key, mac_key = _derive_keys(secret, salt)
+    if not compare_digest(tag, _tag(mac_key, config_file, salt, nonce, ciphertext)):
+        return None
+
+    return loads(_keystream_xor(enc_key, nonce, ciphertext).decode("utf-8"))
+
+
+def _is_expired(entry, now):
+    """
+    Return an indication of whether the given cache entry is older than the
+    configured time to live.
+    """
+    return now - entry.get("stored", 0) > ev_settings().persistent_cache_ttl
+
+
+## ----------------------------------------------------------------------------
+
+
+def _read_entries():
+    """
+    Read the entries from the cache file, if they have not been read already;
+    a missing or damaged file is treated as an empty cache. Must be called
+    with the lock held.
+    """
+    global _entries
+
+    if _entries is not None:
+        return _entries
+
+    _entries = {}
+    filename = _cache_file()
+    if exists(filename):
+        try:
+            with open(filename, "r", encoding="utf-8") as file:
+                _entries = loads(file.read())
+        except (OSError, ValueError) as e:
+            log(f"unable to read the persistent cache: {e}")
+
+    return _entries
+
+
+def _write_entries():
+    """
+    Apply all of the pending changes to the cache entries, drop any that have
+    expired, and write the result to disk. The file is written to a temporary
+    file that then replaces the original, so that a crash part way through
+    can't leave behind a damaged cache.
+
+    The pending entries are already encrypted, so this is quick enough to
+    run on the main thread.
+    """
+    global _write_scheduled
+
+    with _lock:
+        _write_scheduled = False
+        pending = dict(_pending)
+        _pending.clear()
+
+        entries = _read_entries()
+        for config_file, entry in pending.items():
+            if entry is None:
+                entries.pop(config_file, None)
+            else:
+                entries[config_file] = entry
+
+        now = time()
+        for config_file in [c for c, e in entries.items() if _is_expired(e, now)]:
+            del entries[config_file]
+
+        filename = _cache_file()
+        try:
+            makedirs(join(sublime.cache_path(), "Envault"), exist_ok=True)
+            with open(filename + ".tmp", "w", encoding="utf-8") as file:
+                file.write(dumps(entries))
+
+            replace(filename + ".tmp", filename)
+
+        except OSError as e:
+            log(f"unable to write the persistent cache: {e}")
+
+    if ev_settings().debug:
+        log(f"wrote {len(entries)} environment(s) to the persistent cache")
+
+
+def _schedule_write(config_file, entry):
+    """
+    Queue a change to the persisted entry for the given config, and schedule
+    a write of the cache file if one is not already coming.
+    """
+    global _write_scheduled
+
+    with _lock:
+        _pending[config_file] = entry
+        if _write_scheduled:
+            return
+
+        _write_scheduled = True
+
+    sublime.set_timeout_async(_write_entries, WRITE_DELAY)
+
+
+def _queue_env(config_file, apiKeyName, env):
+    """
+    Encrypt the given environment for the given config and queue it to be
+    written out; this is slow, so it runs in the background.
+    """
+    # Re-use the salt of the existing entry when the API key is the same, so
+    # that the derived keys don't have to be derived again.
+    with _lock:
+        old = _pending.get(config_file) or _read_entries().get(config_file)
+
+    salt = (b64decode(old["salt"]) if old and old["apiKeyName"] == apiKeyName
+            else urandom(16))
+
+    _schedule_write(config_file, _encrypt(config_file, apiKeyName, env, salt))
+
+
+## ----------------------------------------------------------------------------
+
+
+def persist_env(config_file, apiKeyName, env):
+    """
+    Persist the environment fetched for the given config to the on disk cache,
+    encrypted with the value of the API key whose name is given; this does
+    nothing unless the persistent cache is turned on.
+
+    The environment is encrypted in the background, and then written along
+    with any other changes that are made around the same time.
+    """
+    if ev_settings().persistent_cache:
+        sublime.set_timeout_async(lambda: _queue_env(config_file, apiKeyName, env))
+
+
+def restore_envs(callback):
+    """
+    Read the persisted environments from the on disk cache in the background;
+    once they are available, the callback is invoked on the main thread with
+    a dict that maps config files to a tuple of the time the environment was
+    stored and the environment itself.
+
+    Entries that have expired, or that can't be decrypted with the current
+    value of their API key, are left out. Nothing happens if the persistent
+    cache is turned off.
+    """
+    if not ev_settings().persistent_cache:
+        return
+
+    def load():
+        with _lock:
+            entries = dict(_read_entries())
+
+        now = time()
+        envs = {}
+        for config_file, entry in entries.items():
+            if _is_expired(entry, now):
+                continue
+
+            try:
+                env = _decrypt(config_file, entry)
+            except (KeyError, ValueError):
+                env = None
+
+            if env is None:
+                log(f"unable to restore the persisted environment for {config_file}")
+            else:
+                envs[config_file] = (entry["stored"], env)
+
+        if envs:
+            sublime.set_timeout(lambda: callback(envs))
+
+    sublime.set_timeout_async(load)
+
+
+def flush_disk_cache():
+    """
+    Write out any changes to the on disk cache that are still pending right
+    away; this is used when the plugin unloads.
+
+    Only environments that have already been encrypted are written, so that
+    this doesn't hold up the main thread; one that was persisted just before
+    the unload may be lost, in which case it is fetched again next time.
+    """
+    with _lock:
+        pending = bool(_pending)
+
+    if pending:
+        _write_entries()
+
+
+## ----------------------------------------------------------------------------
@@ -1,5 +1,17 @@
-from .settings import ev_setting
+import sublime
+
+from .settings import ev_settings
 from .logging import log
+from .envault_data import get_envault_config
+from .env_store import freeze_env, env_layer, EMPTY_ENV
+
+from collections import namedtuple, OrderedDict
+
+from itertools import count
+
+from threading import Lock
+
+from time import monotonic, time
 
 
 ## ----------------------------------------------------------------------------
@@ -9,30 +21,97 @@ from .logging import log
 # particular configuration file loaded this session.
 #
 # In the dict, the key is the fully qualified and absolute filename of an
-# Envault config, and the value is the result of making a query for the
-# variables associated with that file.
-_env_cache = { }
+# Envault config, and the value is a tuple of the time the variables were
+# fetched (None if the fetch failed and there was nothing to keep) and an
+# EnvSnapshot of the result of making a query for the variables associated
+# with that file.
+#
+# The entries are kept in least recently used order, so that when the cache
+# grows past its size limit the environments that have not been used for the
+# longest time can be evicted first.
+_env_cache = OrderedDict()
+
+# A snapshot of the environment for a config; env is an EnvMap, which can't
+# be modified (and shares its storage with other configs that use the same
+# specs), and generation is a number that changes every time the content of
+# the environment for the config changes.
+#
+# Since both parts are immutable, anything that is worked out from a
+# snapshot can be kept and re-used for as long as the generation stays the
+# same. The empty snapshot used for configs with no environment is always
+# generation 0.
+EnvSnapshot = namedtuple("EnvSnapshot", ["generation", "env"])
+EMPTY_SNAPSHOT = EnvSnapshot(0, EMPTY_ENV)
+
+# Every new snapshot is given a generation number from this counter.
+_generation = count(1)
+
+# The configuration files whose environment in the cache above was restored
+# from the persistent cache on disk rather than fetched this session; these
+# are still used, but should be fetched again as soon as possible.
+_restored = set()
+
+# The number of seconds after a fetch of a config fails before a command that
+# uses the config will start another refresh of it; without this, an error
+# that won't go away by itself (such as a bad API key) would be reported on
+# every build.
+FAILED_REFRESH_INTERVAL = 60
+
+# The time at which the last fetch of each config failed; a config is removed
+# from here as soon as a fetch of it succeeds.
+_failed_at = { }
+
+# A second level cache that holds the variables produced by individual specs,
+# for servers that can return their results split by spec; specs are usually
+# shared between many configs, so this allows a config load to only request
+# the specs that no other config has fetched recently.
+#
+# In the dict, the key is a (url, apiKeyName, spec) tuple, and the value is a
+# tuple of the time the spec was fetched and the EnvLayer of the variables it
+# produced. Entries are kept in the order they were fetched, and are dropped
+# once they are older than the time to live, since they are no longer used.
+_spec_cache = OrderedDict()
+
+# The validators (ETag and Last-Modified) of responses from the server, along
+# with the results that were decoded from them; these allow a later identical
+# request to ask the server to only send the results again if they changed.
+#
+# In the dict, the key is the identity of the request (see the request_key
+# property of EnvaultRequest) and the value is a CachedResponse, whose
+# env_keys is an EnvMap and whose spec_results (if any) is a dict of layers.
+# Entries are kept in least recently used order.
+#
+# Responses are stored from the threads that make requests, so this is
+# protected by a lock.
+CachedResponse = namedtuple("CachedResponse",
+                            ["etag", "last_modified", "env_keys", "spec_results"])
+_response_cache = OrderedDict()
+_response_lock = Lock()
 
 
 ## ----------------------------------------------------------------------------
 
 
-def store_env(config_file, new_env):
+def store_env(config_file, new_env, fetched=True):
     """
     Given the full path to a configuration file and the environment result of
     loading it, cache the environment variables into the cache, so that they
     can be retreived later.
 
     If this configuration file already has an entry in the cache, this will
-    replace it.
+    replace it. When fetched is False, the environment is a placeholder for a
+    fetch that failed, which is always due to be fetched again.
     """
     if not config_file:
         return log(f"unable to cache env; no config provided")
 
-    if ev_setting("debug"):
+    if ev_settings().debug:
         log(f"storing environment for {config_file}")
 
-    _env_cache[config_file] = new_env
+    _put_env(config_file, monotonic() if fetched else None, new_env)
+    _restored.discard(config_file)
+    if fetched:
+        _failed_at.pop(config_file, None)
 
 
 def clear_env(config_file):
@@ -41,31 +120,50 @@ def clear_env(config_file):
     This will cause all future cache fetches for this config to return an empty
     dict until the cache is updated with new results.
     """
-    if ev_setting("debug"):
+    if ev_settings().debug:
         log(f"deleting environment for {config_file}")
 
-    if config_file in _env_cache:
-        del _env_cache[config_file]
+    _drop_env(config_file)
 
 
 def fetch_env(config_file):
     """
     Fetch the appropriate environment to use for the given window; the return
-    is a dict of all of the variables and the values therein to be used within
-    this window.
+    is a read only dict of all of the variables and the values therein to be
+    used within this window.
+
+    This is a shortcut for the env of the snapshot that fetch_snapshot()
+    returns.
+    """
+    return fetch_snapshot(config_file).env
 
-    If there is no stored env, an empty dict will be returned.
+
+def fetch_snapshot(config_file):
+    """
+    Fetch the EnvSnapshot of the environment to use for the given window.
+
+    If there is no stored env, the empty snapshot will be returned. A stored
+    env that is past its time to live is still returned (see needs_refresh()),
+    but one that is older than the hard expiry age is not; rather than use
+    secrets that old, the empty snapshot is returned instead.
     """
-    if ev_setting("debug"):
+    if ev_settings().debug:
         log(f"using environment for {config_file}")
 
-    env = _env_cache.get(config_file, None)
-    if env is None:
-        env = {}
-        if ev_setting("debug"):
+    entry = _env_cache.get(config_file, None)
+    if entry is None:
+        if ev_settings().debug:
             log(f"no environment available; using empty default")
 
-    return env
+        return EMPTY_SNAPSHOT
+
+    if entry[0] is not None and _env_age(entry) > _max_age():
+        log(f"environment for {config_file} has expired; using empty default",
+            status=True)
+        return EMPTY_SNAPSHOT
+
+    _env_cache.move_to_end(config_file)
+    return entry[1]
 
 
 def has_env(config_file):
@@ -76,4 +174,278 @@ def has_env(config_file):
     return config_file in _env_cache
 
 
+def needs_refresh(config_file):
+    """
+    Test to see if the environment for the given configuration file should be
+    fetched again; this is the case when it is older than the configured time
+    to live, when the last fetch failed, or when it was restored from the
+    persistent cache rather than fetched this session.
+
+    The stored environment can still be used while the refresh happens, as
+    long as it has not hit the hard expiry age.
+    """
+    entry = _env_cache.get(config_file, None)
+    if entry is None or config_file in _restored:
+        return True
+
+    ttl = ev_settings().env_cache_ttl
+    return _env_age(entry) > (ttl if ttl > 0 else float("inf"))
+
+
+def note_failed_fetch(config_file):
+    """
+    Record that loading or fetching the given config just failed, which holds
+    off refreshes of it by needs_revalidation() for a while.
+    """
+    _failed_at[config_file] = monotonic()
+
+
+def needs_revalidation(config_file):
+    """
+    Test to see if a command that is about to use the environment for the
+    given config should start a refresh of it in the background.
+
+    This is only ever the case for a config that has been loaded before and
+    whose environment needs a refresh (see needs_refresh()); a config that
+    has never loaded is loaded, and reports its problems, when it is chosen
+    or saved, not on every command. A config whose last fetch failed is not
+    tried again until FAILED_REFRESH_INTERVAL seconds have passed.
+    """
+    if not has_env(config_file):
+        return False
+
+    failed = _failed_at.get(config_file)
+    if failed is not None and monotonic() - failed < FAILED_REFRESH_INTERVAL:
+        return False
+
+    return needs_refresh(config_file)
+
+
+def _env_age(entry):
+    """
+    Return the age in seconds of the given environment cache entry; an entry
+    for a failed fetch is infinitely old.
+    """
+    return float("inf") if entry[0] is None else monotonic() - entry[0]
+
+
+def _max_age():
+    """
+    Return the age in seconds after which an environment is too old to be
+    used at all.
+    """
+    max_age = ev_settings().env_cache_max_age
+    return max_age if max_age > 0 else float("inf")
+
+
+def store_restored_envs(envs):
+    """
+    Given a dict of environments restored from the persistent cache on disk,
+    keyed by configuration file, add them to the cache so that they can be
+    used until a fresh copy is fetched. Each value is a tuple of the (wall
+    clock) time the environment was fetched and the environment itself.
+
+    Configurations that already have an environment are left alone, since
+    what they have was fetched this session and is newer.
+    """
+    now = time()
+    for config_file, (stored, env) in envs.items():
+        if config_file not in _env_cache:
+            if ev_settings().debug:
+                log(f"restored persisted environment for {config_file}")
+
+            _put_env(config_file, monotonic() - max(0, now - stored), env)
+            _restored.add(config_file)
+
+
+def _cache_bytes():
+    """
+    Return the approximate number of bytes of memory used by all of the
+    variables held in the environment, spec and response caches; a layer
+    shared by several entries (in any of them) is only counted once.
+    """
+    layers = {}
+    for _, snapshot in _env_cache.values():
+        layers.update((id(layer), layer.size) for layer in snapshot.env.layers)
+
+    for _, layer in _spec_cache.values():
+        layers[id(layer)] = layer.size
+
+    with _response_lock:
+        for response in _response_cache.values():
+            layers.update((id(layer), layer.size) for layer in response.env_keys.layers)
+            layers.update((id(layer), layer.size) for layer in
+                          (response.spec_results or {}).values())
+
+    return sum(layers.values())
+
+
+def _put_env(config_file, fetched_at, env):
+    """
+    Add an entry to the environment cache as the most recently used one, and
+    then evict older entries if the cache has grown too large.
+
+    The entry gets a new generation number, unless the environment is made
+    of exactly the same layers as the one it replaces; since layers are
+    shared by content, this is the case when a refresh did not change
+    anything.
+    """
+    env = freeze_env(env)
+    old = _env_cache.get(config_file)
+    if old is not None and old[1].env.layers == env.layers:
+        snapshot = old[1]
+    else:
+        snapshot = EnvSnapshot(next(_generation), env)
+
+    _env_cache[config_file] = (fetched_at, snapshot)
+    _env_cache.move_to_end(config_file)
+
+    _evict_envs()
+
+
+def _drop_env(config_file):
+    """
+    Remove all trace of the given config from the environment cache.
+    """
+    _env_cache.pop(config_file, None)
+    _restored.discard(config_file)
+    _failed_at.pop(config_file, None)
+
+
+def _evict_envs():
+    """
+    If the variables held in the caches use more memory than the configured
+    limit, evict entries until they fit.
+
+    Cached responses and spec results only save requests, so they go first,
+    least recently used first; after that, the least recently used
+    environments are evicted. The environments of the configs that are
+    selected in any open window are never evicted, since they are what the
+    next build will need; this means that the limit can still be exceeded if
+    they are large enough.
+
+    Evicting an entry only frees the layers that nothing else shares, so the
+    size is worked out again after each one.
+    """
+    _prune_spec_cache()
+
+    limit = ev_settings().env_cache_max_bytes
+    if limit <= 0 or _cache_bytes() <= limit:
+        return
+
+    while _response_cache and _cache_bytes() > limit:
+        with _response_lock:
+            _response_cache.popitem(last=False)
+
+    while _spec_cache and _cache_bytes() > limit:
+        _spec_cache.popitem(last=False)
+
+    if _cache_bytes() <= limit:
+        return
+
+    pinned = {get_envault_config(window) for window in sublime.windows()}
+    for config_file in list(_env_cache):
+        if config_file not in pinned:
+            if ev_settings().debug:
+                log(f"evicting environment for {config_file}")
+
+            _drop_env(config_file)
+            if _cache_bytes() <= limit:
+                break
+
+
+## ----------------------------------------------------------------------------
+
+
+def store_spec_results(url, apiKeyName, spec_results):
+    """
+    Given the server and API key name that a request was made with and the
+    results of that request split by spec, cache the variables of each of the
+    specs, replacing any that were already cached. Nothing is cached when the
+    spec cache is turned off.
+    """
+    if ev_settings().spec_cache_ttl <= 0:
+        return
+
+    now = monotonic()
+    for spec, env in spec_results.items():
+        key = (url, apiKeyName, spec)
+        _spec_cache[key] = (now, env_layer(env or {}))
+        _spec_cache.move_to_end(key)
+
+    _evict_envs()
+
+
+def cached_spec_results(url, apiKeyName, specs):
+    """
+    Look up the cached results for the given list of specs from the given
+    server and API key name. The return value is a tuple of a dict of the
+    results that were found (as layers), keyed by spec, and a list of the
+    specs that were not.
+
+    Results older than the configured time to live are treated as if they
+    were not cached.
+    """
+    ttl = ev_settings().spec_cache_ttl
+    now = monotonic()
+
+    found = {}
+    missing = []
+    for spec in specs:
+        entry = _spec_cache.get((url, apiKeyName, spec))
+        if entry is None or now - entry[0] > ttl:
+            missing.append(spec)
+        else:
+            found[spec] = entry[1]
+
+    return found, missing
+
+
+def _prune_spec_cache():
+    """
+    Drop the cached results of every spec that is older than the configured
+    time to live; these are never used again.
+    """
+    ttl = ev_settings().spec_cache_ttl
+    now = monotonic()
+    while _spec_cache:
+        fetched_at = next(iter(_spec_cache.values()))[0]
+        if now - fetched_at <= ttl:
+            break
+
+        _spec_cache.popitem(last=False)
+
+
+## ----------------------------------------------------------------------------
+
+
+def store_response(request_key, etag, last_modified, env_keys, spec_results):
+    """
+    Given the identity of a request and the validators and decoded results of
+    its response, remember them so that the next identical request can be
+    made conditional.
+
+    These count against the memory limit of the environment cache, but they
+    are only evicted the next time an environment is stored, since this is
+    not called from the main thread.
+    """
+    response = CachedResponse(etag, last_modified, freeze_env(env_keys), spec_results)
+    with _response_lock:
+        _response_cache[request_key] = response
+        _response_cache.move_to_end(request_key)
+
+
+def cached_response(request_key):
+    """
+    Return the CachedResponse for the request with the given identity, or None
+    if there is not one.
+    """
+    with _response_lock:
+        response = _response_cache.get(request_key)
+        if response is not None:
+            _response_cache.move_to_end(request_key)
+
+        return response
+
+
 ## ----------------------------------------------------------------------------
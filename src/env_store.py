@@ -0,0 +1,130 @@
+from collections.abc import Mapping
+
+from hashlib import sha1
+from json import dumps
+
+from sys import getsizeof, intern
+
+from threading import Lock
+
+from weakref import WeakValueDictionary
+
+
+## ----------------------------------------------------------------------------
+
+
+# All of the layers that are currently in use by any environment, keyed by a
+# digest of their content; a layer is shared by every environment that has
+# the same variables in it, and is dropped from here automatically once no
+# environment uses it any longer.
+_layers = WeakValueDictionary()
+_layers_lock = Lock()
+
+
+## ----------------------------------------------------------------------------
+
+
+class EnvLayer():
+    """
+    An immutable set of environment variables that can be shared between many
+    environments; this is usually the variables produced by a single spec.
+
+    The names and values of the variables are interned, so that variables
+    that appear in more than one layer don't take up extra memory either.
+    """
+    __slots__ = ("vars", "size", "__weakref__")
+
+    def __init__(self, env):
+        self.vars = {_intern(k): _intern(v) for k, v in env.items()}
+        self.size = getsizeof(self.vars) + sum(getsizeof(k) + getsizeof(v)
+                                               for k, v in self.vars.items())
+
+    def __len__(self):
+        return len(self.vars)
+
+
+class EnvMap(Mapping):
+    """
+    A read only dictionary of environment variables that is made up of a stack
+    of layers; when more than one layer has the same variable, the value from
+    the layer that is highest in the stack (latest in the list) wins, in the
+    same way as applying each layer to a dict with update() in order.
+    """
+    __slots__ = ("layers",)
+
+    def __init__(self, layers):
+        self.layers = tuple(layers)
+
+    def __getitem__(self, key):
+        for layer in reversed(self.layers):
+            if key in layer.vars:
+                return layer.vars[key]
+
+        raise KeyError(key)
+
+    def __iter__(self):
+        seen = set()
+        for layer in self.layers:
+            for key in layer.vars:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return len(set().union(*(layer.vars for layer in self.layers)))
+
+    def __repr__(self):
+        return f"EnvMap({dict(self)!r})"
+
+
+## ----------------------------------------------------------------------------
+
+
+def _intern(value):
+    """
+    Intern the given value if it is a string, so that all copies of it share
+    the same object.
+    """
+    return intern(value) if isinstance(value, str) else value
+
+
+def env_layer(env):
+    """
+    Return the shared layer that holds the variables in the given dict,
+    creating it if no other environment is using the same variables; this is
+    a no-op for a layer.
+    """
+    if isinstance(env, EnvLayer):
+        return env
+
+    digest = sha1(dumps(env, sort_keys=True).encode("utf-8")).digest()
+    with _layers_lock:
+        layer = _layers.get(digest)
+        if layer is None:
+            layer = _layers[digest] = EnvLayer(env)
+
+        return layer
+
+
+def layered_env(envs):
+    """
+    Given a list of dicts (or layers) of environment variables, return an
+    EnvMap that combines them in order, sharing storage with any other
+    environment that has some of the same dicts in it.
+    """
+    return EnvMap(env_layer(env) for env in envs if env)
+
+
+# The environment used when there is nothing to apply.
+EMPTY_ENV = EnvMap(())
+
+
+def freeze_env(env):
+    """
+    Given an environment, return it as an EnvMap; this is a no-op for one that
+    already is.
+    """
+    return env if isinstance(env, EnvMap) else layered_env([env])
+
+
+## ----------------------------------------------------------------------------
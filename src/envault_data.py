@@ -1,3 +1,10 @@
+# The envault config of each window, keyed by the id of the window; fetching
+# the project data of a window makes Sublime build the whole thing, so the
+# config is only looked up once and then re-used until something happens that
+# could change it.
+_window_configs = { }
+
+
 ## ----------------------------------------------------------------------------
 
 
@@ -40,8 +47,11 @@ def get_envault_config(window):
 
     If there is no file set, the empty string is returned.
     """
-    envault = get_envault_data(window)
-    return envault.get("current", "")
+    config = _window_configs.get(window.id())
+    if config is None:
+        config = _window_configs[window.id()] = get_envault_data(window).get("current", "")
+
+    return config
 
 
 def set_envault_config(window, config):
@@ -55,5 +65,20 @@ def set_envault_config(window, config):
     envault["current"] = config
     set_envault_data(window, envault)
 
+    _window_configs[window.id()] = config
+
+
+def forget_envault_config(window=None):
+    """
+    Forget the envault configuration that was looked up for the given window,
+    so that the next lookup gets it from the project data again; this is for
+    when the project data may have changed. With no window, the configs of
+    all windows are forgotten.
+    """
+    if window is None:
+        _window_configs.clear()
+    else:
+        _window_configs.pop(window.id(), None)
+
 
 ## ----------------------------------------------------------------------------
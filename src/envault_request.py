@@ -1,46 +1,85 @@
 import sublime
 
-from .settings import ev_setting
+from .settings import ev_settings
 from .logging import log
-
-import certifi
+from .connection_pool import pooled_request
+from .env_cache import store_response, cached_response
+from .content_encoding import accept_encoding
+from .resilience import with_retries, run_blocking
+from .env_store import layered_env, env_layer
+from .fetch_registry import CancelToken
 
 from json import dumps
 
 from os import environ
 
-from threading import Thread
-
 from urllib.error import URLError, HTTPError
 from urllib.parse import urlparse, urlunparse
-from urllib.request import urlopen, Request
 
 
 ## ----------------------------------------------------------------------------
 
 
-class EnvaultRequestThread(Thread):
+# The header used to negotiate the format of the response with the server; a
+# request that sets it to "split" asks for the variables produced by each spec
+# to be returned separately, as a dict keyed by spec. A server that honors the
+# request sets the same header in its response, while a server that does not
+# support it ignores it and returns the usual flat dict of variables.
+FORMAT_HEADER = "envault-format"
+FORMAT_SPLIT = "split"
+
+
+## ----------------------------------------------------------------------------
+
+
+class EnvaultRequest():
     """
     Make a request to the Envault API using the provided URL and key, in order
     to fetch the associated environment keys that go with the list of request
     keys provided.
 
-    The request will run in a background thread so as to not hang the UI in
-    Sublime if the request takes too much time.
+    The request is run by one of the worker threads of the fetch executor so
+    as to not hang the UI in Sublime if the request takes too much time.
 
     When the request completes (regardless of success or fail), the callback
     is invoked on the main thread with the result of the query. In the case
     of success, this is a dict that contains the keys; for failure, the result
     is None.
-    """
-    def __init__(self, url, apiKeyName, vars, config_file, callback):
-        super().__init__()
 
+    When split is True, the server is asked to return the results of each spec
+    separately; if it does, spec_results holds the variables of each spec (as
+    shared layers) after the request completes, and is None otherwise.
+
+    If the token is cancelled while the request is running, the request is
+    aborted and the callback is never invoked.
+    """
+    def __init__(self, url, apiKeyName, vars, config_file, callback, split=False,
+                 token=None):
         self.url = self.update_url(url)
         self.apiKeyName = apiKeyName
         self.vars = vars
         self.config_file = config_file
         self.callback = callback
+        self.split = split
+        self.token = token if token is not None else CancelToken()
+        self.spec_results = None
+
+        # The cached response that this request was made conditional on, if
+        # any; this is what a 304 (Not Modified) response refers to.
+        self.cached = None
+
+        # The server that this request talks to; the executor uses this to
+        # limit the number of simultaneous requests to the same server.
+        self.host = urlparse(self.url).netloc
+
+    @property
+    def request_key(self):
+        """
+        The identity of this request; two requests with the same key ask the
+        server for the same thing.
+        """
+        return (self.url, self.apiKeyName, tuple(self.vars), self.split)
+
 
     def update_url(self, url):
         """
@@ -54,24 +93,10 @@ class EnvaultRequestThread(Thread):
         return urlunparse((scheme, netloc, path, params, query, fragment))
 
 
-    def run(self):
+    def request_headers(self):
         """
-        Make an envault request to the specific url in order to fetch the
-        values of the keys provided.
-
-        An api key must be provided, which is the name of an existing
-        environment variable that specifies the actual key to use in the
-        request.
-
-        The request will be sent with the list of keys, and results in a
-        dictionary that represents the various environment variables and the
-        values that should be assigned to them. This need not (and likely is
-        not) the same as any of the keys provided in the request itself.
+        Return the headers to be sent with the request.
         """
-        if ev_setting("debug"):
-            log(f"Making key request with '{self.apiKeyName}' via '{self.url}'")
-            log(f"Keys requested: {', '.join(self.vars)}")
-
         # Look up the API key to use; the key we get is actually the name of an
         # environment variable that contains the actual API key.
         apikey_value = environ.get(self.apiKeyName, "unknown")
@@ -85,41 +110,224 @@ class EnvaultRequestThread(Thread):
         # the Cloudflare Dashboard for the domain, hit Security > Settings and
         # then either turn off the Browser Integrity Check, or set an explicit
         # exemption for this particular user agent
+        #
+        # The connection is explicitly kept alive so that it can be returned to
+        # the connection pool and re-used by the next request to this server,
+        # and we ask for the response to be compressed, since some configs can
+        # produce a large number of large variables.
         headers = {
             "api-key": apikey_value,
+            "Accept-Encoding": accept_encoding(),
+            "Connection": "keep-alive",
             "Content-Type": "application/json; charset=utf-8",
             "User-Agent": 'Sublime/Envault v0.0.1',
         }
 
-        # Create the payload; it has to be a JSON object that is encoded as
-        # bytes.
-        data = dumps(self.vars).encode('utf-8')
+        if self.split:
+            headers[FORMAT_HEADER] = FORMAT_SPLIT
 
-        env_keys = None
-        try:
-            req = Request(self.url, data, headers, method="POST")
-            with urlopen(req, cafile=certifi.where()) as res:
-                body = res.read().decode("utf-8")
-                env_keys = sublime.decode_value(body)
+        # If we have the results of this same request from before, ask the
+        # server to only send them again if they have changed.
+        self.cached = cached_response(self.request_key)
+        if self.cached is not None:
+            if self.cached.etag:
+                headers["If-None-Match"] = self.cached.etag
+            if self.cached.last_modified:
+                headers["If-Modified-Since"] = self.cached.last_modified
+
+        return headers
+
+
+    def request_body(self):
+        """
+        Return the payload of the request; it has to be a JSON object that is
+        encoded as bytes.
+        """
+        return dumps(self.vars).encode('utf-8')
+
+
+    def log_request(self):
+        """
+        Log that the request is being made, if debugging is turned on.
+        """
+        if ev_settings().debug:
+            log(f"Making key request with '{self.apiKeyName}' via '{self.url}'")
+            log(f"Keys requested: {', '.join(self.vars)}")
+
+
+    def decode_response(self, body, headers):
+        """
+        Given the raw body and headers of a successful response, decode it and
+        return the resulting dictionary of environment variables.
+
+        If the server returned the results split by spec, they are saved in
+        spec_results, and the returned dictionary is the combination of all of
+        them, applied in the order that the specs were requested.
+        """
+        result = sublime.decode_value(body.decode("utf-8"))
+        if not isinstance(result, dict):
+            raise ValueError("response is not a JSON object")
+
+        if not self.split or headers.get(FORMAT_HEADER) != FORMAT_SPLIT:
+            return result
+
+        if not all(isinstance(v, dict) for v in result.values()):
+            raise ValueError("split response has results that are not JSON objects")
+
+        self.spec_results = {spec: env_layer(env) for spec, env in result.items()}
+        return merge_spec_results(self.spec_results, self.vars)
+
+
+    def process_response(self, status, headers, body):
+        """
+        Given the status, headers and raw body of a successful response, return
+        the resulting dictionary of environment variables.
 
+        A 304 (Not Modified) response re-uses the results of the cached
+        response that the request was made conditional on, without anything to
+        decode; otherwise the body is decoded and, if the server provided
+        validators for it, cached for the next identical request.
+        """
+        if status == 304:
+            if self.cached is None:
+                raise URLError("server sent 304 for an unconditional request")
+
+            if ev_settings().debug:
+                log(f"results from {self.url} not modified; using cached results")
+
+            self.spec_results = self.cached.spec_results
+            return self.cached.env_keys
+
+        env_keys = self.decode_response(body, headers)
+
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if etag or last_modified:
+            store_response(self.request_key, etag, last_modified,
+                           env_keys, self.spec_results)
+
+        return env_keys
+
+
+    def report_error(self, error):
+        """
+        Report on a request that failed; error is the HTTPError or URLError
+        that describes the problem.
+        """
         # TODO: This does not handle errors well; at the moment the service
         #       does not well define error states, so we're punting for the
         #       MVP version.
-        except HTTPError as e:
+        if isinstance(error, HTTPError):
             log(f"error fetching from {self.url} (from: {self.config_file})")
-            log(f"http error: {e.code}")
+            log(f"http error: {error.code}")
             log(f"error while fetching data from Envault", error=True)
 
             # The error result is sometimes but not always a JSON object, so
             # for the time being just dump it to the console; we can work out
             # how to get a meaningful error message out of it later.
-            print(f"{str(e.read().decode('utf-8'))}")
+            print(f"{str(error.read().decode('utf-8'))}")
 
-        except URLError as e:
+        else:
             log(f"error fetching from {self.url} (from: {self.config_file})")
-            log(f"url error: {e.reason}")
+            log(f"url error: {error.reason}")
+
+
+    def report_unexpected_error(self, error):
+        """
+        Report on a request that failed with an error other than the ones that
+        report_error() handles, such as a response that is not valid JSON.
+        """
+        log(f"error fetching from {self.url} (from: {self.config_file})")
+        log(f"unexpected error: {error!r}")
+        log(f"error while fetching data from Envault", error=True)
+
+
+    def complete(self, env_keys):
+        """
+        Hand the result of the request to the callback on the main thread; the
+        result is the dict of environment variables, or None on failure.
+
+        Nothing is handed back for a request that was cancelled.
+        """
+        if self.token.cancelled:
+            if ev_settings().debug:
+                log(f"dropping result of cancelled request to {self.url}")
+            return
 
         sublime.set_timeout(lambda: self.callback(env_keys))
 
 
+    def run(self):
+        """
+        Make an envault request to the specific url in order to fetch the
+        values of the keys provided.
+
+        An api key must be provided, which is the name of an existing
+        environment variable that specifies the actual key to use in the
+        request.
+
+        The request will be sent with the list of keys, and results in a
+        dictionary that represents the various environment variables and the
+        values that should be assigned to them. This need not (and likely is
+        not) the same as any of the keys provided in the request itself.
+
+        Connecting to the server and each read of the response are limited by
+        the connect_timeout and read_timeout settings.
+        """
+        if self.token.cancelled:
+            return
+
+        env_keys = None
+        try:
+            env_keys = self.fetch()
+        except Exception as e:
+            self.report_unexpected_error(e)
+
+        # This always has to happen, even if the request failed in a way that
+        # was not expected; otherwise the fetch would stay in flight forever
+        # and every later fetch of the config would wait on it.
+        self.complete(env_keys)
+
+
+    def fetch(self):
+        """
+        Make the request, retrying it as needed, and return the resulting
+        dictionary of environment variables, or None if it failed.
+        """
+        self.log_request()
+
+        async def attempt():
+            res = pooled_request("POST", self.url, self.request_body(),
+                                 self.request_headers(),
+                                 connect_timeout=ev_settings().connect_timeout,
+                                 read_timeout=ev_settings().read_timeout,
+                                 token=self.token)
+            return self.process_response(res.status, res.headers, res.body)
+
+        async def sleep(delay):
+            return self.token.wait(delay)
+
+        env_keys, error = run_blocking(with_retries(self.host, self.url, attempt, sleep))
+        if error is not None and not self.token.cancelled:
+            self.report_error(error)
+
+        return env_keys
+
+
+## ----------------------------------------------------------------------------
+
+
+def merge_spec_results(spec_results, specs):
+    """
+    Given a dict of the results of a split request, keyed by spec, return back
+    the combined environment for the list of specs provided; specs later in the
+    list take precedence over earlier ones.
+
+    The result is an EnvMap layered over the results of each spec, so configs
+    that use the same specs share their variables rather than each holding a
+    copy of them.
+    """
+    return layered_env(spec_results.get(spec) for spec in specs)
+
+
 ## ----------------------------------------------------------------------------
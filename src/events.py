@@ -2,22 +2,79 @@ import sublime
 import sublime_plugin
 
 from .config_file import scan_project_configs, load_and_fetch_config
+from .command_hosts import env_commands_for
 from .config_status import set_status_config
-from .env_cache import has_env, fetch_env
-from .envault_data import get_envault_config, set_envault_config
+from .fetch_registry import is_fetching
+from .env_cache import has_env, fetch_snapshot, needs_refresh, needs_revalidation
+from .envault_data import get_envault_config, set_envault_config, forget_envault_config
 from .logging import log
-from .settings import ev_setting
+from .settings import ev_settings
+from .timings import timed
 
 
 ## ----------------------------------------------------------------------------
 
 
+# The environment that was last handed to the environment commands, as a
+# tuple of the config, the generation of the snapshot it came from, and the
+# plain dict version of it; running the same build over and over re-uses this
+# rather than converting the snapshot each time.
+_command_env = (None, None, {})
+
+# The same as the above, but for the environment that is injected into the
+# arguments of commands when the environment is scoped; this includes the
+# extra variables that the environment command would otherwise add.
+_scoped_env = (None, None, {})
+
+# The configs for which a refresh has been scheduled by a command that is
+# about to run, but not started yet.
+_revalidating = set()
+
+
+## ----------------------------------------------------------------------------
+
+
+def command_env(config_file):
+    """
+    Return the environment for the given config as a tuple of the generation
+    of its snapshot and a plain dict that can be passed as a command argument.
+    """
+    global _command_env
+
+    snapshot = fetch_snapshot(config_file)
+    if _command_env[:2] != (config_file, snapshot.generation):
+        _command_env = (config_file, snapshot.generation, dict(snapshot.env))
+
+    return _command_env[1:]
+
+
+def scoped_env(config_file):
+    """
+    Return the environment to inject into the env argument of a command for
+    the given config; this is the environment of the config along with the
+    ENVAULT and ENVAULT_CONFIG variables, just as the environment command
+    would set them.
+    """
+    global _scoped_env
+
+    generation, env = command_env(config_file) if config_file else (0, { })
+    if _scoped_env[:2] != (config_file, generation):
+        new_env = {"ENVAULT": "1", "ENVAULT_CONFIG": config_file}
+        new_env.update(env)
+        _scoped_env = (config_file, generation, new_env)
+
+    return _scoped_env[2]
+
+
 def load_project_config(config_file):
     """
     Given a window's envault configuration file, schedule a fetch to get the
     environment to use for it.
+
+    An environment that is already loaded is only fetched again if it is due
+    for a refresh; it is used in the meantime.
     """
-    if has_env(config_file):
+    if has_env(config_file) and not needs_refresh(config_file):
         return log(f"no fetch needed; already loaded {config_file}")
 
     log(f"doing project load fetch for {config_file}")
@@ -61,6 +118,17 @@ class EnvaultEventListener(sublime_plugin.EventListener):
     finished executing in the current window and, if required, update or
     restore the environment in the host.
     """
+    # The environment commands that were used to set the environment for each
+    # command that is currently running, so that it can be restored in the
+    # same plugin hosts it was set in; there is no entry for a command whose
+    # environment was not set.
+    env_hosts = { }
+
+    # The ids of the windows in which a build has just started; the next
+    # command that runs in the window is the target of the build, and is
+    # given the environment (or the plugin host that it runs in is).
+    pending_builds = set()
+
     def is_build(self, command, args):
         """
         Return a determination of whether the provided command is a valid build
@@ -75,51 +143,163 @@ class EnvaultEventListener(sublime_plugin.EventListener):
 
     def is_watched_command(self, command):
         """
-        Check to see if the command provided is within the list of commands
+        Check to see if the command provided matches the list of commands
         that the user has configured as one that should be watched, to extend
         how the environment gets extended.
         """
-        return command in ev_setting("added_watch_commands")
+        return command in ev_settings().watch_matcher
+
+
+    def is_scoped(self, command, args):
+        """
+        Check to see if the environment for the command provided should be
+        scoped to it, rather than being applied to the plugin hosts.
+
+        This is the case for the commands that can be given their environment
+        directly, and also for builds, since the build system target that the
+        build runs will be one of those commands.
+        """
+        settings = ev_settings()
+        if settings.env_injection != "scoped":
+            return False
+
+        return self.is_build(command, args) or command in settings.scoped_commands
+
+
+    def window_config(self, window):
+        """
+        Return the envault config selected in the given window (or the empty
+        string if there is not one) for a command that is about to run.
+
+        An environment that is past its time to live is still used for the
+        command so that it doesn't have to wait, but a refresh is scheduled
+        so that the next one gets fresh values; see needs_revalidation() for
+        when that happens. The refresh starts once the command is under way,
+        since loading the config reads it from disk.
+        """
+        config = get_envault_config(window)
+        if (config and config not in _revalidating and not is_fetching(config)
+                and needs_revalidation(config)):
+            log(f"refreshing environment for {config}")
+            _revalidating.add(config)
 
+            def refresh():
+                _revalidating.discard(config)
+                load_and_fetch_config(config)
 
-    def execute_env_op(self, window, cmd, operation, config_file, env):
+            sublime.set_timeout(refresh)
+
+        return config
+
+
+    @timed("execute_env_op")
+    def execute_env_op(self, window, cmd, operation, config_file, env, generation=None,
+                       target=None):
         """
-        Execute the given environment update operation in both of the plugin
-        hosts, using the environment dictionary provided.
+        Execute the given environment update operation in the plugin hosts
+        that the command runs in (both of them if that is not known), using
+        the environment dictionary provided; the generation of the
+        environment lets the hosts re-use the work they did the last time
+        they were given the same one.
+
+        For a build, target is the command that the build runs, which is the
+        one whose plugin hosts are used. A restore goes to the hosts that the
+        environment was set in, and does nothing if it was not set.
         """
-        for env_cmd in ('envault_internal_env_38', 'envault_internal_env_33'):
+        if operation == "set":
+            env_cmds = self.env_hosts[cmd] = env_commands_for(target or cmd)
+        else:
+            env_cmds = self.env_hosts.pop(cmd, ())
+
+        for env_cmd in env_cmds:
             window.run_command(env_cmd, {
                 "command": cmd,
                 "operation": operation,
                 "config_file": config_file,
-                "env": env
+                "env": env,
+                "generation": generation
             })
 
 
+    @timed("on_window_command")
     def on_window_command(self, window, cmd, args):
         """
         If the command about to be executed in the window is a valid build
         command, then trigger the command that will update the plugin host
         environment before the command executes.
+
+        A build doesn't set anything itself; the environment is set when the
+        build runs its target command (the next command in the window), and
+        only in the plugin host that the target is in.
+
+        When the environment is scoped, commands that take an env argument
+        are instead rewritten to pass the environment to it. Only the commands
+        that would get the environment otherwise are rewritten; that is,
+        watched commands and the target of a build that just started.
         """
-        # We only care about build commands and watched commands
-        if self.is_build(cmd, args) or self.is_watched_command(cmd):
-            # Check for a known envault config; if so, fetch the environment
-            # for it. Otherwise, we can just use an empty environment. This is
-            # what happens for windows that don't have a config.
-            config = get_envault_config(window)
-            env = fetch_env(config) if config else { }
-            self.execute_env_op(window, cmd, "set", config, env)
+        if self.is_build(cmd, args):
+            # This starts a refresh of the environment if it needs one.
+            self.window_config(window)
+            self.pending_builds.add(window.id())
+            return None
+
+        build_target = window.id() in self.pending_builds
+        self.pending_builds.discard(window.id())
+
+        if self.is_scoped(cmd, args):
+            if not (build_target or self.is_watched_command(cmd)):
+                return None
+
+            # Variables that the command was already given take precedence,
+            # the same as they would over the environment of the host.
+            env = dict(scoped_env(self.window_config(window)))
+            env.update((args or {}).get("env") or {})
+
+            return (cmd, dict(args or {}, env=env))
 
+        # When the environment is scoped, a build target that can't be given
+        # the environment directly doesn't get it at all.
+        if build_target and ev_settings().env_injection != "scoped":
+            self.set_command_env(window, "build", cmd)
 
+        if self.is_watched_command(cmd):
+            self.set_command_env(window, cmd)
+
+
+    def set_command_env(self, window, cmd, target=None):
+        """
+        Set the environment of the config of the window in the plugin hosts
+        for the given command, which is about to run; for a build, target is
+        the command that the build is running.
+        """
+        # Check for a known envault config; if so, fetch the environment for
+        # it. Otherwise, we can just use an empty environment. This is what
+        # happens for windows that don't have a config.
+        config = self.window_config(window)
+        generation, env = command_env(config) if config else (0, { })
+        self.execute_env_op(window, cmd, "set", config, env, generation, target)
+
+
+    @timed("on_post_window_command")
     def on_post_window_command(self, window, cmd, args):
         """
         If the command that just `executed `in the window was a valid build
         command, then trigger the command that will restore the plugin host
         environment to what it was before the command originally executed.
         """
-        # We only care about build commands and watched commands
-        if self.is_build(cmd, args) or self.is_watched_command(cmd):
+        # A build that didn't run a target leaves nothing to restore. When the
+        # environment is scoped, nothing was applied to the plugin hosts for
+        # the commands that were given it directly.
+        if self.is_build(cmd, args):
+            self.pending_builds.discard(window.id())
+            if cmd in self.env_hosts:
+                self.execute_env_op(window, cmd, "restore", "", { })
+            return
+
+        if self.is_scoped(cmd, args):
+            return
+
+        if self.is_watched_command(cmd):
             self.execute_env_op(window, cmd, "restore", "", { })
 
 
@@ -134,6 +314,8 @@ class EnvaultEventListener(sublime_plugin.EventListener):
         If it does not, do a scan to see if there are any configurations
         available, and if so choose one as needed.
         """
+        # This may be a different project than the window had before.
+        forget_envault_config(window)
         config = get_envault_config(window)
         if config:
             load_project_config(config)
@@ -146,9 +328,16 @@ class EnvaultEventListener(sublime_plugin.EventListener):
         When a file is saved, if it appears in the list of currently loaded
         configuration values, reload and re-query the environment associated
         with it.
+
+        Saving a project file may change the config that is selected in any
+        window that uses it, so the configs of all windows are looked up again
+        when that happens.
         """
         config_file = view.file_name()
-        if ev_setting("reload_config_on_save") and has_env(config_file):
+        if config_file and config_file.endswith(".sublime-project"):
+            forget_envault_config()
+
+        if ev_settings().reload_config_on_save and has_env(config_file):
             log(f"reloading envault config {config_file}")
             load_and_fetch_config(config_file)
 
@@ -168,6 +357,17 @@ class EnvaultEventListener(sublime_plugin.EventListener):
     on_load = on_clone = on_new = update_view_status_keys
 
 
+    def on_pre_close_window(self, window):
+        """
+        When a window or the project in it is closing, forget the config that
+        was looked up for it.
+        """
+        forget_envault_config(window)
+
+
+    on_pre_close_project = on_pre_close_window
+
+
     def on_pre_move(self, view):
         """
         Since the event to tell us when an event to move a view from one
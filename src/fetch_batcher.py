@@ -0,0 +1,215 @@
+import sublime
+
+from .settings import ev_settings
+from .logging import log
+
+from .env_cache import store_spec_results, cached_spec_results
+from .envault_data import get_envault_config
+from .envault_request import EnvaultRequest, merge_spec_results
+from .fetch_executor import submit_fetch, PRIORITY_ACTIVE, PRIORITY_NORMAL
+from .fetch_registry import CancelToken
+from .async_fetch import submit_async_fetch
+
+from collections import namedtuple
+
+
+## ----------------------------------------------------------------------------
+
+
+# A fetch that is waiting to be sent; config is the loaded config, and the
+# callback is invoked on the main thread with the environment that results
+# from it (or None if the request failed), unless the token is cancelled
+# first. When force is True, the request is made for every spec in the config
+# even if some of them are cached.
+#
+# When the fetch is sent, cached is set to the results of the specs that were
+# left out of the request because they were cached, so that they can't expire
+# out of the cache while the request is running.
+_PendingFetch = namedtuple("_PendingFetch",
+                           ["config_file", "config", "callback", "token", "force",
+                            "cached"])
+
+# The fetches that have been scheduled but not yet sent, and whether or not a
+# flush of them has already been scheduled.
+_pending = []
+_flush_scheduled = False
+
+# What we know about whether each server (by url) can return results split by
+# spec. Servers that are not known to be unable to do this are sent a single
+# combined request for configs with different vars; if the results come back
+# without being split, there is no way to tell which variables belong to
+# which config, so those configs are re-fetched on their own, and the server
+# is sent separate requests from then on.
+_split_servers = { }
+
+
+## ----------------------------------------------------------------------------
+
+
+def _submit(request, config_files):
+    """
+    Hand a request off to the configured fetch backend; requests that are for
+    the config in the active window are given priority.
+    """
+    if ev_settings().fetch_backend == "asyncio":
+        future = submit_async_fetch(request)
+        request.token.attach(future.cancel)
+        return
+
+    active = get_envault_config(sublime.active_window()) in config_files
+    submit_fetch(request.host, request.run,
+                 PRIORITY_ACTIVE if active else PRIORITY_NORMAL)
+
+
+def _send(url, apiKeyName, specs, members):
+    """
+    Make a single request to the given server for the list of specs provided,
+    on behalf of all of the pending fetches in members.
+
+    The request is only cancelled if all of the members are; when it
+    completes, each member that is still waiting is given the environment for
+    its own list of specs; this requires the server to have split the results by
+    spec unless all of the members asked for the same specs. Split results
+    are also added to the spec cache, and any of a member's specs that were
+    not part of the request are taken from there.
+    """
+    config_files = [m.config_file for m in members]
+
+    def done(env_keys):
+        if env_keys is not None:
+            _split_servers[url] = request.spec_results is not None
+            if request.spec_results is not None:
+                store_spec_results(url, apiKeyName, request.spec_results)
+
+        mixed = []
+        for member in members:
+            if member.token.cancelled:
+                continue
+
+            if env_keys is None:
+                member.callback(None)
+            elif request.spec_results is not None:
+                member.callback(_spec_env(url, apiKeyName, member, request.spec_results))
+            elif member.config["vars"] == specs:
+                member.callback(env_keys)
+            else:
+                mixed.append(member)
+
+        # The server has stopped splitting its results, so the members that
+        # asked for different specs have to be fetched on their own.
+        if mixed:
+            log(f"{url} did not split results; re-fetching {len(mixed)} config(s)")
+            _send_individually(url, apiKeyName, mixed)
+
+    if ev_settings().debug and len(members) > 1:
+        log(f"batching {len(members)} configs into one request to {url}")
+
+    token = CancelToken.all_of(m.token for m in members)
+    request = EnvaultRequest(url, apiKeyName, specs, ", ".join(config_files),
+                             done, token=token, split=True)
+    _submit(request, config_files)
+
+
+def _spec_env(url, apiKeyName, member, spec_results):
+    """
+    Build the environment for a pending fetch out of the split results of the
+    request that was made for it, using the cached results for any of its
+    specs that were not requested because they were already cached.
+    """
+    specs = member.config["vars"]
+    results = dict(member.cached)
+    results.update((s, spec_results[s]) for s in specs if s in spec_results)
+
+    return merge_spec_results(results, specs)
+
+
+def _send_individually(url, apiKeyName, members):
+    """
+    Send one request for each distinct list of specs in the given members;
+    members that ask for exactly the same specs still share a request.
+    """
+    by_specs = {}
+    for member in members:
+        by_specs.setdefault(tuple(member.config["vars"]), []).append(member)
+
+    for specs, group in by_specs.items():
+        _send(url, apiKeyName, list(specs), group)
+
+
+def _flush():
+    """
+    Send all of the pending fetches, combining the ones that are for the same
+    server and API key into as few requests as possible.
+    """
+    global _pending, _flush_scheduled
+
+    pending, _pending = _pending, []
+    _flush_scheduled = False
+
+    groups = {}
+    for fetch in pending:
+        if fetch.token.cancelled:
+            continue
+
+        key = (fetch.config["url"], fetch.config["apiKeyName"])
+        groups.setdefault(key, []).append(fetch)
+
+    for (url, apiKeyName), members in groups.items():
+        if _split_servers.get(url) is False:
+            _send_individually(url, apiKeyName, members)
+            continue
+
+        # Collect the union of all of the specs that are not already cached,
+        # preserving the order in which they first appear; members that have
+        # every spec cached can be answered right away.
+        specs = []
+        waiting = []
+        for member in members:
+            cached, missing = {}, member.config["vars"]
+            if not member.force and ev_settings().spec_cache_ttl > 0:
+                cached, missing = cached_spec_results(url, apiKeyName, missing)
+
+            member = member._replace(cached=cached)
+            if not missing:
+                if ev_settings().debug:
+                    log(f"all specs for {member.config_file} are cached")
+
+                member.callback(_spec_env(url, apiKeyName, member, {}))
+                continue
+
+            waiting.append(member)
+            for spec in missing:
+                if spec not in specs:
+                    specs.append(spec)
+
+        if waiting:
+            _send(url, apiKeyName, specs, waiting)
+
+
+## ----------------------------------------------------------------------------
+
+
+def schedule_fetch(config_file, config, callback, token, force=False):
+    """
+    Schedule a request for the given loaded config; the callback is invoked on
+    the main thread with the resulting environment, or None on failure. If the
+    token is cancelled, the request is aborted and the callback is dropped.
+
+    Requests are held for a short time before being sent, so that requests for
+    configs that use the same server and API key can be sent together. Specs
+    that are in the spec cache are not requested again unless force is True.
+    """
+    global _flush_scheduled
+
+    _pending.append(_PendingFetch(config_file, config, callback, token, force, {}))
+
+    delay = ev_settings().fetch_batch_delay
+    if delay <= 0:
+        return _flush()
+
+    if not _flush_scheduled:
+        _flush_scheduled = True
+        sublime.set_timeout(_flush, delay)
+
+
+## ----------------------------------------------------------------------------
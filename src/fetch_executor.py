@@ -0,0 +1,154 @@
+from .settings import ev_settings
+from .logging import log
+
+from itertools import count
+
+from threading import Condition, Thread
+
+from traceback import print_exc
+
+
+## ----------------------------------------------------------------------------
+
+
+# Jobs in the queue are ordered first by priority and then by the order in
+# which they were submitted; jobs that are for the config in the active window
+# jump ahead of everything else.
+PRIORITY_ACTIVE = 0
+PRIORITY_NORMAL = 1
+
+
+## ----------------------------------------------------------------------------
+
+
+class FetchExecutor():
+    """
+    A shared pool of worker threads that run Envault requests; this puts an
+    upper bound on the number of requests that can be running at once, no
+    matter how many configs are being fetched.
+
+    Jobs are queued in FIFO order, except that priority jobs are always run
+    before normal ones. Each job is associated with the host that it talks to,
+    and no more than the configured number of jobs per host will be running at
+    any given time; a job for a host that is at its limit waits in the queue
+    while jobs for other hosts are allowed to run.
+    """
+    def __init__(self):
+        self._cond = Condition()
+        self._seq = count()
+
+        # The queue of pending jobs, as (priority, sequence, host, job) tuples,
+        # and a count of running jobs per host.
+        self._queue = []
+        self._running = {}
+
+        # Shutting down bumps the epoch; workers from an older epoch exit as
+        # soon as they finish what they are doing, even if new jobs arrive.
+        self._workers = []
+        self._epoch = 0
+
+
+    def submit(self, host, job, priority=PRIORITY_NORMAL):
+        """
+        Queue a job to run in a worker thread; the job is a callable that
+        takes no arguments, and host is the server that it will talk to.
+        """
+        with self._cond:
+            self._queue.append((priority, next(self._seq), host, job))
+
+            self._workers = [w for w in self._workers if w.is_alive()]
+            if len(self._workers) < max(1, ev_settings().fetch_workers):
+                worker = Thread(target=self._work, args=(self._epoch,), daemon=True)
+                self._workers.append(worker)
+                worker.start()
+
+            self._cond.notify()
+
+
+    def _next_job(self, epoch):
+        """
+        Wait for and return the next job that is allowed to run, marking its
+        host as having one more running job. The return value is None if the
+        executor has been shut down since the worker was started.
+        """
+        with self._cond:
+            while True:
+                if epoch != self._epoch:
+                    return None
+
+                limit = max(1, ev_settings().fetch_host_limit)
+                ready = [e for e in self._queue if self._running.get(e[2], 0) < limit]
+                if ready:
+                    entry = min(ready)
+                    self._queue.remove(entry)
+                    self._running[entry[2]] = self._running.get(entry[2], 0) + 1
+                    return entry
+
+                self._cond.wait()
+
+
+    def _work(self, epoch):
+        """
+        The body of each worker thread; jobs are taken from the queue and run
+        until the executor is shut down.
+        """
+        while True:
+            entry = self._next_job(epoch)
+            if entry is None:
+                return
+
+            _, _, host, job = entry
+            try:
+                job()
+            except Exception:
+                log(f"unhandled error in fetch for {host}")
+                print_exc()
+
+            with self._cond:
+                if self._running.get(host, 0) > 0:
+                    self._running[host] -= 1
+                self._cond.notify_all()
+
+
+    def shutdown(self, timeout=1.0):
+        """
+        Stop the executor; jobs that have not started yet are discarded, and
+        the workers are given a short time to finish the job that they are
+        currently running, if any.
+        """
+        with self._cond:
+            self._epoch += 1
+            if self._queue:
+                log(f"discarding {len(self._queue)} pending fetch(es)")
+
+            self._queue = []
+            self._running = {}
+            self._cond.notify_all()
+            workers, self._workers = self._workers, []
+
+        for worker in workers:
+            worker.join(timeout)
+
+
+## ----------------------------------------------------------------------------
+
+
+# The executor that runs all of the requests made by the package.
+_executor = FetchExecutor()
+
+
+def submit_fetch(host, job, priority=PRIORITY_NORMAL):
+    """
+    Queue a job in the shared fetch executor; see FetchExecutor.submit().
+    """
+    _executor.submit(host, job, priority)
+
+
+def shutdown_fetches():
+    """
+    Shut down the shared fetch executor; see FetchExecutor.shutdown().
+    """
+    _executor.shutdown()
+
+
+## ----------------------------------------------------------------------------
@@ -0,0 +1,211 @@
+from .settings import ev_settings
+from .logging import log
+
+from hashlib import sha1
+from itertools import count
+from json import dumps
+
+from threading import Lock, Event
+
+
+## ----------------------------------------------------------------------------
+
+
+# Every fetch that is started is assigned a generation number from this
+# counter; since it only ever increases, a higher generation always represents
+# a more recent request.
+_generation = count(1)
+
+# The fetches that are currently in progress; the key is the fully qualified
+# and absolute filename of an Envault config, and the value is the _Flight
+# that tracks the request that is running for it.
+#
+# There is only ever one entry per config; a new fetch for the same config
+# with different request content replaces the entry, which makes the response
+# of the older request stale.
+_in_flight = { }
+
+
+## ----------------------------------------------------------------------------
+
+
+class CancelToken():
+    """
+    A token that tracks whether a fetch has been cancelled.
+
+    Code that is blocked on a fetch (such as a read on a socket) can attach a
+    function to the token that aborts it, so that cancelling the token stops
+    the fetch right away instead of when the blocking call returns. Such a
+    function must be detached again once it no longer applies.
+    """
+    def __init__(self):
+        self.cancelled = False
+        self._lock = Lock()
+        self._event = Event()
+        self._aborts = []
+
+
+    @classmethod
+    def all_of(cls, tokens):
+        """
+        Return a new token that is cancelled once every one of the tokens
+        provided has been cancelled; this is used for a single request that
+        is made on behalf of several fetches.
+        """
+        combined = cls()
+        tokens = list(tokens)
+
+        def check():
+            if all(t.cancelled for t in tokens):
+                combined.cancel()
+
+        for token in tokens:
+            token.attach(check)
+
+        check()
+        return combined
+
+
+    def attach(self, abort):
+        """
+        Attach a function to be called if the token is cancelled; if it has
+        already been cancelled, the function is called right away.
+        """
+        with self._lock:
+            if not self.cancelled:
+                return self._aborts.append(abort)
+
+        abort()
+
+
+    def detach(self, abort):
+        """
+        Detach a function that was previously attached with attach().
+        """
+        with self._lock:
+            if abort in self._aborts:
+                self._aborts.remove(abort)
+
+
+    def cancel(self):
+        """
+        Cancel the token, calling all of the attached functions.
+        """
+        with self._lock:
+            if self.cancelled:
+                return
+
+            self.cancelled = True
+            self._event.set()
+            aborts, self._aborts = self._aborts, []
+
+        for abort in aborts:
+            abort()
+
+
+    def wait(self, timeout):
+        """
+        Block for up to timeout seconds, returning early if the token is
+        cancelled; the return value indicates whether it was.
+        """
+        return self._event.wait(timeout)
+
+
+## ----------------------------------------------------------------------------
+
+
+class _Flight():
+    """
+    Simple tracking object for a fetch that is currently in progress; this
+    knows the generation of the request, a digest of the content that is being
+    requested, the token that cancels it, and the list of callbacks to be
+    invoked when the fetch is done.
+    """
+    def __init__(self, digest, generation):
+        self.digest = digest
+        self.generation = generation
+        self.token = CancelToken()
+        self.waiters = []
+
+
+## ----------------------------------------------------------------------------
+
+
+def request_digest(config):
+    """
+    Given a loaded and validated config, return back a digest that represents
+    the content of the request that would be made for it; two configs with the
+    same digest produce the same request.
+    """
+    return sha1(dumps(config, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def begin_fetch(config_file, digest, callback=None):
+    """
+    Register the intent to fetch the given config, whose request content has
+    the digest provided.
+
+    If an identical fetch for this config is already in progress, the callback
+    (if any) is attached to it and None is returned, indicating that no new
+    request should be made.
+
+    Otherwise, a tuple of the generation number and cancellation token for
+    the new request is returned, and the caller is expected to make the
+    request and pass the generation to end_fetch() when it completes. An older
+    request for this config is cancelled, since its result is now stale, and
+    any callbacks that were waiting on it are moved to the new one.
+    """
+    flight = _in_flight.get(config_file)
+    if flight is not None and flight.digest == digest:
+        if ev_settings().debug:
+            log(f"attaching to in-flight fetch for {config_file}")
+
+        if callback is not None:
+            flight.waiters.append(callback)
+
+        return None
+
+    new_flight = _Flight(digest, next(_generation))
+    if flight is not None:
+        if ev_settings().debug:
+            log(f"superseding in-flight fetch for {config_file}")
+
+        new_flight.waiters.extend(flight.waiters)
+        flight.token.cancel()
+
+    if callback is not None:
+        new_flight.waiters.append(callback)
+
+    _in_flight[config_file] = new_flight
+    return new_flight.generation, new_flight.token
+
+
+def is_fetching(config_file):
+    """
+    Test to see if a fetch of the given config is currently in progress.
+    """
+    return config_file in _in_flight
+
+
+def end_fetch(config_file, generation):
+    """
+    Indicate that the fetch of the given generation for the given config has
+    completed.
+
+    If this is the most recent fetch for the config, it is removed from the
+    registry and the list of callbacks waiting on it is returned. If a newer
+    fetch has been started since this one, the result of this one is stale
+    and None is returned instead.
+    """
+    flight = _in_flight.get(config_file)
+    if flight is None or flight.generation != generation:
+        if ev_settings().debug:
+            log(f"discarding stale response for {config_file} (generation {generation})")
+
+        return None
+
+    del _in_flight[config_file]
+    return flight.waiters
+
+
+## ----------------------------------------------------------------------------
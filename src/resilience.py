@@ -0,0 +1,250 @@
+from .settings import ev_settings
+from .logging import log
+
+from http.client import HTTPException
+
+from random import uniform
+
+from threading import Lock
+from time import monotonic
+
+from urllib.error import URLError, HTTPError
+
+
+## ----------------------------------------------------------------------------
+
+
+# The longest that we will ever wait between two attempts at a request, no
+# matter how many attempts have been made.
+MAX_RETRY_DELAY = 10.0
+
+# HTTP status codes that indicate a problem that is likely to go away on its
+# own; any other error status (such as an invalid API key) is permanent.
+TRANSIENT_STATUS_CODES = (408, 425, 429, 500, 502, 503, 504)
+
+
+## ----------------------------------------------------------------------------
+
+
+class CircuitOpenError(URLError):
+    """
+    The error used to fail a request without trying to make it, because the
+    circuit breaker for the server it would talk to is open.
+    """
+    pass
+
+
+class FetchCancelledError(URLError):
+    """
+    The error used to fail a request that was cancelled because its result is
+    no longer needed.
+    """
+    pass
+
+
+## ----------------------------------------------------------------------------
+
+
+def retry_delays():
+    """
+    Yield the number of seconds to wait before each attempt at a request; the
+    first attempt is made right away, and each retry waits a random amount of
+    time up to an exponentially growing limit ("full jitter"), so that the
+    retries from many windows don't all land on the server at once.
+    """
+    yield 0
+
+    base = ev_settings().fetch_retry_delay
+    for attempt in range(max(0, ev_settings().fetch_retries)):
+        yield uniform(0, min(MAX_RETRY_DELAY, base * (2 ** attempt)))
+
+
+def is_transient(error):
+    """
+    Given the URLError (or HTTPError) that a request failed with, return an
+    indication of whether the problem is likely to be temporary, which makes
+    the request worth trying again.
+    """
+    if isinstance(error, (CircuitOpenError, FetchCancelledError)):
+        return False
+
+    if isinstance(error, HTTPError):
+        return error.code in TRANSIENT_STATUS_CODES
+
+    return isinstance(error.reason, (OSError, EOFError, HTTPException))
+
+
+## ----------------------------------------------------------------------------
+
+
+class CircuitBreaker():
+    """
+    Track the health of a single server, so that while it is down requests to
+    it fail right away rather than each one waiting for its own failure.
+
+    The breaker starts closed, allowing all requests. Once enough fetches in
+    a row fail, it opens and requests are refused until the cool down period
+    has passed; it is then half open, and exactly one request is allowed
+    through as a probe. If the probe works, the breaker closes again, and if it
+    fails the breaker re-opens for another cool down period. A probe that
+    never reports back (because it was cancelled) only holds things up for
+    one more cool down period, after which another probe is let through.
+
+    A fetch counts as a single failure no matter how many times it was
+    retried, so that one fetch can't open the breaker on its own.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, host):
+        self.host = host
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+
+        self._lock = Lock()
+
+
+    def allow(self):
+        """
+        Return an indication of whether a request to this server should be
+        made right now.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            cooldown = ev_settings().circuit_breaker_cooldown
+            if monotonic() - self.opened_at >= cooldown:
+                log(f"probing {self.host} after {cooldown}s cool down")
+                self.state = self.HALF_OPEN
+                self.opened_at = monotonic()
+                return True
+
+            return False
+
+
+    def record_success(self):
+        """
+        Note that a request to this server worked (or at least that the server
+        responded), closing the breaker.
+        """
+        with self._lock:
+            if self.state != self.CLOSED:
+                log(f"{self.host} is responding again")
+
+            self.state = self.CLOSED
+            self.failures = 0
+
+
+    def record_failure(self):
+        """
+        Note that a fetch from this server failed, opening the breaker if the
+        failure threshold has been reached or if this was the probe request.
+        """
+        with self._lock:
+            self.failures += 1
+            threshold = max(1, ev_settings().circuit_breaker_threshold)
+            if self.state == self.HALF_OPEN or self.failures >= threshold:
+                if self.state != self.OPEN:
+                    log(f"{self.host} is not responding; pausing requests to it")
+
+                self.state = self.OPEN
+                self.opened_at = monotonic()
+
+
+## ----------------------------------------------------------------------------
+
+
+# The circuit breakers for all of the servers that we have talked to, keyed by
+# the host (and port) of the server.
+_breakers = { }
+_breakers_lock = Lock()
+
+
+def circuit_for(host):
+    """
+    Return the circuit breaker for the given host, creating it if needed.
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(host)
+
+        return breaker
+
+
+## ----------------------------------------------------------------------------
+
+
+async def with_retries(host, url, attempt, sleep):
+    """
+    Make a request to the given host (for the given url) by awaiting the
+    attempt coroutine function, which returns the result of the request or
+    raises a URLError if it fails. Transient failures are retried with a
+    backoff, by awaiting sleep(delay) between attempts; sleep returns True if
+    the request was cancelled while it was waiting.
+
+    Requests are refused without being made while the circuit breaker for
+    the host is open, and the outcome of the request is recorded in it.
+
+    The return value is a tuple of the result of the request and the URLError
+    that made it fail; the result is None unless the request worked, and the
+    error is None if it worked or was cancelled.
+
+    Both fetch backends use this; the asyncio backend awaits it on its loop,
+    and the thread backend passes coroutine functions that block instead of
+    awaiting anything and runs it with run_blocking().
+    """
+    breaker = circuit_for(host)
+
+    error = None
+    for delay in retry_delays():
+        if error is not None:
+            log(f"retrying request to {url} in {delay:.2f}s")
+            if await sleep(delay):
+                break
+
+        if not breaker.allow():
+            if error is None:
+                return None, CircuitOpenError(f"requests to {host} are paused")
+            break
+
+        try:
+            result = await attempt()
+            breaker.record_success()
+            return result, None
+
+        except FetchCancelledError:
+            return None, None
+
+        except URLError as e:
+            error = e
+            if not is_transient(e):
+                # The server answered, even if it was to refuse us.
+                breaker.record_success()
+                return None, e
+
+    # Every attempt failed in a way that might have been temporary; the fetch
+    # as a whole counts as one failure.
+    breaker.record_failure()
+    return None, error
+
+
+def run_blocking(coroutine):
+    """
+    Run a coroutine that never suspends (because everything that it awaits
+    blocks instead) to completion in the current thread, and return its
+    result.
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration as done:
+        return done.value
+
+    coroutine.close()
+    raise RuntimeError("coroutine suspended outside of an event loop")
+
+
+## ----------------------------------------------------------------------------
@@ -1,35 +1,139 @@
 import sublime
 
+from .command_matcher import CommandMatcher
+from .logging import log
+
+from collections import namedtuple
+
 
 ## ----------------------------------------------------------------------------
 
 
-def ev_setting(key):
+# The name of the settings file for the package.
+#
+# Note: the core also loads this settings file so that it can add a setting
+#       listener without causing a circular reference in other code; if you
+#       change the config file name, change it there too.
+SETTINGS_FILE = "Envault.sublime-settings"
+
+# The default values of all of the settings; the type of the default is also
+# the type that the setting is required to have.
+SETTING_DEFAULTS = {
+    "status_bar_format": "[Envault: ${file_base_name}]",
+
+    # Template file actually lists some packages here.
+    "added_watch_commands": [],
+
+    "env_injection": "global",
+    "scoped_env_commands": ["exec", "terminus_exec", "terminus_open"],
+
+    "default_api_key": "envault_dev_key",
+    "default_api_url": "http://localhost:8787/",
+
+    "reload_config_on_save": True,
+
+    "fetch_backend": "thread",
+    "connect_timeout": 10,
+    "read_timeout": 30,
+
+    "fetch_batch_delay": 10,
+
+    "spec_cache_ttl": 300,
+
+    "env_cache_ttl": 3600,
+    "env_cache_max_age": 86400,
+    "env_cache_max_bytes": 8 * 1024 * 1024,
+
+    "persistent_cache": False,
+    "persistent_cache_ttl": 86400,
+
+    "fetch_retries": 2,
+    "fetch_retry_delay": 0.5,
+    "circuit_breaker_threshold": 3,
+    "circuit_breaker_cooldown": 30,
+
+    "fetch_workers": 4,
+    "fetch_host_limit": 2,
+
+    "max_response_size": 16 * 1024 * 1024,
+
+    "connection_pool_size": 8,
+    "connection_idle_timeout": 30,
+
+    "ca_bundle": "",
+    "verify_ssl": True,
+
+    "collect_timings": False,
+
+    "debug": False
+}
+
+# An immutable snapshot of all of the settings; the fields are the names of
+# the settings, plus some values that are worked out from them:
+#   - watch_matcher is a CommandMatcher for added_watch_commands
+#   - scoped_commands is a frozenset of scoped_env_commands
+EnvaultSettings = namedtuple("EnvaultSettings",
+                             list(SETTING_DEFAULTS) + ["watch_matcher", "scoped_commands"])
+
+# The current settings snapshot; this is created the first time the settings
+# are used, and replaced every time that they change.
+_snapshot = None
+
+
+## ----------------------------------------------------------------------------
+
+
+def _typed_setting(settings, key):
+    """
+    Get the value of the given setting, making sure that it has the same type
+    as its default value; a value of the wrong type is reported and the
+    default is used instead. Numbers are interchangeable, except booleans.
+    """
+    default = SETTING_DEFAULTS[key]
+    value = settings.get(key, default)
+
+    expected = type(default)
+    if expected in (int, float) and not isinstance(value, bool):
+        expected = (int, float)
+
+    if isinstance(value, bool) != isinstance(default, bool) or not isinstance(value, expected):
+        log(f"setting '{key}' has the wrong type; using the default")
+        return default
+
+    return value
+
+
+def reload_settings():
     """
-    Get an Envault setting from a cached settings object.
+    Create a new snapshot of the current settings, which replaces the old
+    one; this is called whenever the settings change.
     """
-    if getattr(ev_setting, "obj", None) is None:
-        # Note: the core also loads this settings file so that it can add
-        #       a setting listener without causing a circular reference in
-        #       other code; if you change the config file name, change it there
-        #       too.
-        ev_setting.obj = sublime.load_settings("Envault.sublime-settings")
-        ev_setting.default = {
-            "status_bar_format": "[Envault: ${file_base_name}]",
+    global _snapshot
+
+    settings = sublime.load_settings(SETTINGS_FILE)
+    values = {key: _typed_setting(settings, key) for key in SETTING_DEFAULTS}
+
+    values["watch_matcher"] = CommandMatcher(values["added_watch_commands"])
+    values["scoped_commands"] = frozenset(c for c in values["scoped_env_commands"]
+                                          if isinstance(c, str))
 
-            # Template file actually lists some packages here.
-            "added_watch_commands": [],
+    _snapshot = EnvaultSettings(**values)
+    return _snapshot
 
-            "default_api_key": "envault_dev_key",
-            "default_api_url": "http://localhost:8787/",
 
-            "reload_config_on_save": True,
+def ev_settings():
+    """
+    Return the current snapshot of the Envault settings; the settings are
+    plain attributes of it.
+    """
+    return _snapshot or reload_settings()
 
-            "debug": False
-        }
 
-    default = ev_setting.default.get(key, None)
-    return ev_setting.obj.get(key, default)
+def ev_setting(key):
+    """
+    Get an Envault setting from the current settings snapshot.
+    """
+    return getattr(ev_settings(), key)
 
 
 ## ----------------------------------------------------------------------------
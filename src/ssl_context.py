@@ -0,0 +1,153 @@
+import ssl
+
+from .settings import ev_settings
+from .logging import log
+
+import certifi
+
+from http.client import HTTPConnection, HTTPSConnection
+
+from threading import Lock
+
+
+## ----------------------------------------------------------------------------
+
+
+# The lock that protects the cached context and the session cache; requests
+# are made from background threads, so these can be touched concurrently.
+_lock = Lock()
+
+# The SSL context that is used for all https requests, and the key that it
+# was built from; the key is a tuple of the CA bundle that was loaded and the
+# certificate verification settings, and when the settings no longer produce
+# the same key the context is rebuilt.
+_context = None
+_context_key = None
+
+# TLS sessions from previous connections, which allow a new connection to the
+# same server to resume the session rather than doing a full handshake. The
+# key is a (host, port) tuple and the value is the last session seen for it.
+#
+# Sessions are tied to the context that created them, so this is cleared
+# whenever the context is rebuilt.
+_sessions = {}
+
+
+## ----------------------------------------------------------------------------
+
+
+def _ca_bundle():
+    """
+    Return the CA bundle file that should be used to verify certificates; this
+    is the user's configured bundle, if any, and the bundle from certifi if
+    not.
+    """
+    return ev_settings().ca_bundle or certifi.where()
+
+
+def get_ssl_context():
+    """
+    Return the SSL context to use for https requests, building it only if it
+    has not been built yet or if the settings it was built from have changed
+    since it was created.
+    """
+    global _context, _context_key
+
+    key = (_ca_bundle(), ev_settings().verify_ssl)
+    with _lock:
+        if _context is None or _context_key != key:
+            cafile, verify = key
+            if ev_settings().debug:
+                log(f"creating SSL context using '{cafile}' (verify: {verify})")
+
+            context = ssl.create_default_context(cafile=cafile)
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+
+            _context, _context_key = context, key
+            _sessions.clear()
+
+        return _context
+
+
+def clear_ssl_context():
+    """
+    Throw away the cached SSL context and any saved TLS sessions, so that the
+    next request will build them again.
+    """
+    global _context, _context_key
+
+    with _lock:
+        _context = None
+        _context_key = None
+        _sessions.clear()
+
+
+## ----------------------------------------------------------------------------
+
+
+class ResumingHTTPSConnection(HTTPSConnection):
+    """
+    An HTTPS connection that will attempt to resume the last TLS session that
+    was used to talk to the same server, if there is one, so that reconnects
+    can use an abbreviated handshake.
+    """
+    def connect(self):
+        """
+        Connect to the server and perform the TLS handshake, offering the last
+        known session for this server for resumption.
+        """
+        HTTPConnection.connect(self)
+
+        server_hostname = self._tunnel_host or self.host
+        with _lock:
+            session = _sessions.get(self._session_key())
+            if session is not None and self._context is not _context:
+                session = None
+
+        self.sock = self._context.wrap_socket(self.sock,
+                                              server_hostname=server_hostname,
+                                              session=session)
+
+        # The connection drops its socket when the server asks for it to be
+        # closed, so keep our own reference for save_session() to use.
+        self._tls_sock = self.sock
+
+        if session is not None and ev_settings().debug:
+            log(f"TLS session to {self.host}:{self.port} resumed: {self.sock.session_reused}")
+
+
+    def save_session(self):
+        """
+        Remember the TLS session that is in use on this connection so that a
+        later connection to the same server can resume it.
+
+        This should be called after the response headers have been read but
+        before the body is; with TLS 1.3 the session ticket is not sent until
+        after the handshake completes, and the session is no longer available
+        once a connection the server closed has been fully read.
+        """
+        sock = getattr(self, "_tls_sock", None)
+        session = sock.session if sock is not None else None
+        if session is None:
+            return
+
+        with _lock:
+            if self._context is _context:
+                _sessions[self._session_key()] = session
+
+
+    def _session_key(self):
+        """
+        Return the key that sessions with the server are remembered under;
+        this is the server at the far end of the tunnel when the connection
+        goes through a proxy.
+        """
+        if self._tunnel_host:
+            return (self._tunnel_host, self._tunnel_port)
+
+        return (self.host, self.port)
+
+
+## ----------------------------------------------------------------------------
@@ -0,0 +1,94 @@
+import sublime
+
+from .settings import ev_settings
+from .commands import env_command
+
+from collections import deque
+from functools import wraps
+from math import ceil
+from time import perf_counter
+
+
+## ----------------------------------------------------------------------------
+
+
+# The timings of each phase of handling a command, keyed by the name of the
+# phase; the value is a ring buffer of the most recent durations, in seconds.
+# Only the phases that run in this plugin host are recorded here; the
+# environment command keeps its own, since it also runs in the legacy host.
+_timings = { }
+
+
+## ----------------------------------------------------------------------------
+
+
+def record_timing(phase, elapsed):
+    """
+    Record that the given phase took the given number of seconds.
+    """
+    samples = _timings.get(phase)
+    if samples is None:
+        samples = _timings[phase] = deque(maxlen=env_command.TIMING_SAMPLES)
+
+    samples.append(elapsed)
+
+
+def timed(phase):
+    """
+    Decorate a function so that the time it takes is recorded under the name
+    of the given phase, while the collect_timings setting is turned on.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ev_settings().collect_timings:
+                return func(*args, **kwargs)
+
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record_timing(phase, perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+## ----------------------------------------------------------------------------
+
+
+def _percentile(samples, percent):
+    """
+    Given a sorted list of samples, return the given percentile of them, using
+    the nearest rank.
+    """
+    return samples[max(0, ceil(len(samples) * percent / 100) - 1)]
+
+
+def timing_summary():
+    """
+    Return a list of the timings recorded for each phase in both plugin
+    hosts, as tuples of the name of the phase, the number of samples, and the
+    50th, 95th and 99th percentile durations in seconds.
+    """
+    phases = [(phase, samples) for phase, samples in _timings.items()]
+    phases.extend((f"{phase} ({env_command.host})", samples)
+                  for phase, samples in env_command.timings.items())
+
+    # The legacy plugin host publishes its timings, since it is a different
+    # process.
+    legacy = sublime.load_settings(env_command.HOSTS_SETTINGS).get("timings_33") or {}
+    phases.extend((f"{phase} (3.3)", samples) for phase, samples in legacy.items())
+
+    summary = []
+    for phase, samples in phases:
+        samples = sorted(samples)
+        if samples:
+            summary.append((phase, len(samples), _percentile(samples, 50),
+                            _percentile(samples, 95), _percentile(samples, 99)))
+
+    return summary
+
+
+## ----------------------------------------------------------------------------
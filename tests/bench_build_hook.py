@@ -0,0 +1,107 @@
+"""
+Benchmark the latency that Envault adds to a build, by driving the event
+listener hooks (on_window_command, execute_env_op and on_post_window_command)
+and the environment command (set_env and restore_env) the same way that
+Sublime does, for configs with 10, 1,000 and 10,000 variables.
+
+Each build runs an exec target, which is when the environment is set.
+Builds alternate between two windows with different configs, and after each
+build the environment of the process is checked to be exactly what it was
+before, so this also catches environments leaking from one build (or window)
+into another.
+
+The timings come from the collect_timings instrumentation of the package,
+and are reported in milliseconds; the hook phases include the calls for both
+the build and its target. Only the 3.8 plugin host is exercised,
+since the 3.3 host is a separate process.
+
+    python tests/bench_build_hook.py [iterations]
+"""
+import os
+import sys
+
+import support
+
+import sublime
+
+from Envault.src import timings
+from Envault.src.commands import env_command
+from Envault.src.commands.env_command import EnvaultEnvironmentCommand
+from Envault.src.env_cache import store_env
+from Envault.src.events import EnvaultEventListener
+from Envault.src.timings import timing_summary
+
+
+## ----------------------------------------------------------------------------
+
+
+VARIABLE_COUNTS = (10, 1000, 10000)
+
+
+class BenchWindow(sublime.Window):
+    """
+    A window that runs the environment command of this plugin host when it
+    is asked to, the way Sublime would.
+    """
+    def __init__(self, config_file):
+        super().__init__({"envault": {"current": config_file}})
+        self.env_command = EnvaultEnvironmentCommand(self)
+
+    def run_command(self, command, args=None):
+        if command == self.env_command.name():
+            self.env_command.run(**args)
+
+
+## ----------------------------------------------------------------------------
+
+
+def bench(count, iterations):
+    """
+    Run the given number of builds in each of two windows whose configs have
+    the given number of variables, and return the timing summary.
+    """
+    support.configure(collect_timings=True)
+    timings._timings.clear()
+    env_command.timings.clear()
+    env_command.env_state = env_command.EnvironmentState()
+
+    windows = []
+    for name in ("first", "second"):
+        config_file = f"/bench/{name}-{count}.yml"
+        store_env(config_file, {f"BENCH_{name.upper()}_{i}": f"{name}-{i}"
+                                for i in range(count)})
+        windows.append(BenchWindow(config_file))
+
+    listener = EnvaultEventListener()
+    original = os.environ.copy()
+
+    for _ in range(iterations):
+        for window in windows:
+            listener.on_window_command(window, "build", {})
+            listener.on_window_command(window, "exec", {})
+            listener.on_post_window_command(window, "exec", {})
+            listener.on_post_window_command(window, "build", {})
+            sublime.run_timeouts()
+
+            if os.environ != original:
+                leaked = set(os.environ.items()) ^ set(original.items())
+                raise AssertionError(f"environment leaked after a build: {len(leaked)} variable(s)")
+
+    return timing_summary()
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    print(f"{'variables':>9}  {'phase':<28} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for count in VARIABLE_COUNTS:
+        for phase, samples, p50, p95, p99 in bench(count, iterations):
+            print(f"{count:>9}  {phase:<28} {samples:>6} "
+                  f"{p50 * 1000:>9.3f} {p95 * 1000:>9.3f} {p99 * 1000:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
+
+
+## ----------------------------------------------------------------------------
@@ -0,0 +1,122 @@
+"""
+Benchmark what conditional requests save on a reload whose results have not
+changed, which is the usual case for a reload triggered by saving a config.
+
+A stand-in server answers the same request over and over, for configs with
+100, 1,000 and 10,000 variables. In the "full" mode it sends no validators,
+so every reload downloads and decodes the whole payload as it did before
+conditional requests; in the "conditional" mode it sends an ETag, and after
+the first request answers with 304 (Not Modified) and no body.
+
+For each mode this reports the response bytes per reload, and the time per
+reload spent handling the response (process_response, which decodes the
+body) and for the whole request, in milliseconds. The stand-in server does
+not compress its responses, so the byte counts are of the raw JSON.
+
+    python tests/bench_conditional_requests.py [iterations]
+"""
+import sys
+
+from statistics import median
+from time import perf_counter
+
+import support
+
+import sublime
+
+from Envault.src import env_cache
+from Envault.src.envault_request import EnvaultRequest
+
+
+## ----------------------------------------------------------------------------
+
+
+VARIABLE_COUNTS = (100, 1000, 10000)
+
+ETAG = '"bench"'
+
+
+class TimedRequest(EnvaultRequest):
+    """
+    A request that records how long handling each response takes.
+    """
+    process_times = []
+
+    def process_response(self, status, headers, body):
+        start = perf_counter()
+        try:
+            return super().process_response(status, headers, body)
+        finally:
+            self.process_times.append(perf_counter() - start)
+
+
+## ----------------------------------------------------------------------------
+
+
+def bench(count, conditional, iterations):
+    """
+    Reload a config with the given number of variables the given number of
+    times (after an initial request that primes the cache), and return the
+    average response bytes and the median handling and request times.
+    """
+    support.configure(fetch_retries=0)
+    env_cache._response_cache.clear()
+
+    payload = {f"BENCH_VAR_{i}": f"value-{i:08d}-" + "x" * 32 for i in range(count)}
+    sent = []
+
+    def respond(request, headers):
+        if conditional and headers.get("If-None-Match") == ETAG:
+            status, response_headers, body = 304, {"ETag": ETAG}, b""
+        else:
+            status, response_headers, body = support.json_response(payload)
+            if conditional:
+                response_headers["ETag"] = ETAG
+
+        sent.append(len(body))
+        return status, response_headers, body
+
+    server = support.StandInServer(respond)
+    try:
+        def reload():
+            results = []
+            request = TimedRequest(server.url, "BENCH_KEY", ["bench"], "/bench.yml",
+                                   lambda env: results.append(env))
+            request.run()
+            sublime.run_timeouts()
+            if not results or len(results[0]) != count:
+                raise AssertionError("reload did not return the expected variables")
+
+        reload()
+        del sent[:]
+        del TimedRequest.process_times[:]
+
+        request_times = []
+        for _ in range(iterations):
+            start = perf_counter()
+            reload()
+            request_times.append(perf_counter() - start)
+
+    finally:
+        server.close()
+
+    return (sum(sent) / len(sent), median(TimedRequest.process_times),
+            median(request_times))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    print(f"{'variables':>9}  {'mode':<12} {'bytes':>10} {'handle ms':>10} {'request ms':>11}")
+    for count in VARIABLE_COUNTS:
+        for mode in ("full", "conditional"):
+            size, handle, request = bench(count, mode == "conditional", iterations)
+            print(f"{count:>9}  {mode:<12} {size:>10.0f} "
+                  f"{handle * 1000:>10.3f} {request * 1000:>11.3f}")
+
+
+if __name__ == "__main__":
+    main()
+
+
+## ----------------------------------------------------------------------------
@@ -0,0 +1,140 @@
+"""
+Benchmark the time per build that it takes to apply an environment to the
+process and then restore it, with process environments of 100, 500 and
+2,000 variables and a config of 50 variables.
+
+The "clear" approach is the one the environment command used to take: it
+clears os.environ and fills it back up from a copy of the original
+environment, on both set and restore, which is an unsetenv() and a putenv()
+for every variable in the process. The "diff" approach is the environment
+command as it is now, which only touches the variables that differ.
+
+Builds alternate between two configs, so that both approaches switch
+between environments the way they would with two windows open. Times are
+per build (a set followed by a restore) in milliseconds.
+
+    python tests/bench_env_apply.py [iterations]
+"""
+import os
+import sys
+
+from statistics import median, quantiles
+from time import perf_counter
+
+import support
+
+import sublime
+
+from Envault.src.commands import env_command
+from Envault.src.commands.env_command import EnvaultEnvironmentCommand
+
+
+## ----------------------------------------------------------------------------
+
+
+PROCESS_COUNTS = (100, 500, 2000)
+
+CONFIG_VARS = 50
+
+
+class ClearApply():
+    """
+    The way the environment command applied and restored environments before
+    it applied them as a diff.
+    """
+    def __init__(self):
+        self.original_env = None
+
+    def run(self, command, operation, config_file, env, generation=None):
+        if operation == "set":
+            if self.original_env is None:
+                self.original_env = os.environ.copy()
+
+            new_env = self.original_env.copy()
+            new_env.update(env)
+            for var, value in (("ENVAULT", "1"), ("ENVAULT_CONFIG", config_file)):
+                if var not in env:
+                    new_env[var] = value
+
+            os.environ.clear()
+            os.environ.update(new_env)
+
+        else:
+            def restore():
+                os.environ.clear()
+                os.environ.update(self.original_env)
+
+            sublime.set_timeout_async(restore)
+
+
+class DiffApply():
+    """
+    The environment command as it is now.
+    """
+    def __init__(self):
+        env_command.env_state = env_command.EnvironmentState()
+        self.command = EnvaultEnvironmentCommand(sublime.Window())
+
+    def run(self, command, operation, config_file, env, generation=None):
+        self.command.run(command, operation, config_file, env, generation)
+
+
+## ----------------------------------------------------------------------------
+
+
+def bench(approach, process_count, iterations):
+    """
+    Run the given number of builds with the given approach in a process
+    environment with the given number of variables, and return the time each
+    build took.
+    """
+    saved = os.environ.copy()
+    os.environ.update({f"BENCH_PROCESS_{i}": f"process-{i}" for i in range(process_count - len(saved))})
+    original = os.environ.copy()
+
+    configs = []
+    for generation, name in enumerate(("first", "second"), start=1):
+        env = {f"BENCH_{name.upper()}_{i}": f"{name}-{i}" for i in range(CONFIG_VARS)}
+        configs.append((f"/bench/{name}.yml", env, generation))
+
+    try:
+        runner = approach()
+        times = []
+        for build in range(iterations):
+            config_file, env, generation = configs[build % 2]
+
+            start = perf_counter()
+            runner.run("build", "set", config_file, env, generation)
+            runner.run("build", "restore", "", {})
+            sublime.run_timeouts()
+            times.append(perf_counter() - start)
+
+            if os.environ != original:
+                raise AssertionError(f"{approach.__name__} did not restore the environment")
+
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+    return times
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    support.configure()
+
+    print(f"{'process vars':>12}  {'approach':<10} {'p50':>9} {'p95':>9}")
+    for process_count in PROCESS_COUNTS:
+        for approach in (ClearApply, DiffApply):
+            times = bench(approach, process_count, iterations)
+            p95 = quantiles(times, n=20)[-1]
+            name = approach.__name__[:-5].lower()
+            print(f"{process_count:>12}  {name:<10} "
+                  f"{median(times) * 1000:>9.3f} {p95 * 1000:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
+
+
+## ----------------------------------------------------------------------------
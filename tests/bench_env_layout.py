@@ -0,0 +1,115 @@
+"""
+Benchmark the memory used to hold the environments of many configs that
+share most of their variables, in the layouts that the env cache can use.
+
+Each of 30 configs uses a shared "auth" and "db" spec (100 variables each)
+and a spec of 10 variables of its own, and every config is decoded from its
+own response, as it would be when it is fetched. The layouts are:
+
+    flat        a separate dict for each config (the layout before layers)
+    layered     an EnvMap for each config over one layer with the whole
+                response, which shares the interned names and values
+    split       an EnvMap for each config over a layer for each spec, as a
+                server that splits its results by spec produces, which
+                also shares the layers of the common specs
+
+The memory is measured with tracemalloc and only counts what is still held
+once the responses have been decoded and stored.
+
+    python tests/bench_env_layout.py [configs]
+"""
+import gc
+import sys
+import tracemalloc
+
+from json import dumps, loads
+
+import support
+
+from Envault.src.env_store import layered_env
+
+
+## ----------------------------------------------------------------------------
+
+
+SHARED_SPECS = {
+    spec: {f"{spec.upper()}_VAR_{i}": f"{spec}-value-{i:04d}-" + "s" * 24 for i in range(100)}
+    for spec in ("auth", "db")
+}
+
+
+def responses(configs):
+    """
+    Return the raw response for each config, as a tuple of the body of the
+    whole response and the body of the response split by spec.
+    """
+    result = []
+    for config in range(configs):
+        specs = dict(SHARED_SPECS)
+        specs[f"config{config}"] = {f"CONFIG_VAR_{i}": f"config-{config}-{i}" for i in range(10)}
+
+        env = {}
+        for spec_env in specs.values():
+            env.update(spec_env)
+
+        result.append((dumps(env), dumps(specs)))
+
+    return result
+
+
+def flat(whole, split):
+    return loads(whole)
+
+
+def layered(whole, split):
+    return layered_env([loads(whole)])
+
+
+def split(whole, split):
+    return layered_env(loads(split).values())
+
+
+## ----------------------------------------------------------------------------
+
+
+def measure(layout, bodies):
+    """
+    Store the environment of each of the response bodies in the given layout,
+    and return the number of bytes that is held by them along with the
+    environments themselves.
+    """
+    gc.collect()
+    tracemalloc.start()
+    envs = [layout(whole, split) for whole, split in bodies]
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return size, envs
+
+
+def main():
+    configs = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    bodies = responses(configs)
+
+    expected = [loads(whole) for whole, _ in bodies]
+    baseline = None
+
+    print(f"{'layout':<10} {'configs':>8} {'bytes':>12} {'per config':>11} {'vs flat':>8}")
+    for layout in (flat, layered, split):
+        size, envs = measure(layout, bodies)
+        if [dict(env) for env in envs] != expected:
+            raise AssertionError(f"the {layout.__name__} layout changed the variables")
+
+        baseline = baseline or size
+        print(f"{layout.__name__:<10} {configs:>8} {size:>12} "
+              f"{size // configs:>11} {size / baseline:>8.2f}")
+
+        del envs
+
+
+if __name__ == "__main__":
+    main()
+
+
+## ----------------------------------------------------------------------------
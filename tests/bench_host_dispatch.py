@@ -0,0 +1,174 @@
+"""
+Benchmark the latency that the build hooks add to builds and to watched
+commands, before and after the environment is only set in the plugin host
+that runs the command.
+
+Sublime runs plugins in two separate plugin host processes, and running the
+environment command of the other host is a round trip to that process. Here
+the 3.3 host is stood in for by a child process that runs its own copy of
+the environment command, and the window sends it each command over a pipe
+and waits for it to finish, while the 3.8 host is this process.
+
+The watched command, which is also the target that the builds run, is a
+window command of the 3.8 host. In the "before" mode it can't be resolved
+to a host, so the environment is set in both, which is what happened for
+every build and command before host-aware dispatch; in the "after" mode it
+is resolved to the 3.8 host only. Times are in milliseconds, for all of the
+hooks of one run together; a build runs the hooks of its target as well as
+its own.
+
+    python tests/bench_host_dispatch.py [iterations]
+"""
+import sys
+
+from multiprocessing import get_context
+from statistics import median, quantiles
+from time import perf_counter
+
+import support
+
+import sublime
+import sublime_plugin
+
+from Envault.src import command_hosts
+from Envault.src.command_hosts import ENV_COMMANDS
+from Envault.src.commands.env_command import EnvaultEnvironmentCommand
+from Envault.src.env_cache import store_env
+from Envault.src.events import EnvaultEventListener
+
+
+## ----------------------------------------------------------------------------
+
+
+WATCHED_COMMAND = "bench_run"
+
+BUILD_TARGET = "bench_build"
+
+CONFIG_VARS = 100
+
+
+class BenchRunCommand(sublime_plugin.WindowCommand):
+    """
+    The watched command; it is only a window command of the 3.8 host once it
+    has been registered.
+    """
+    def run(self):
+        pass
+
+
+class BenchBuildCommand(BenchRunCommand):
+    """
+    The target of the builds.
+    """
+
+
+def other_host(connection):
+    """
+    Stand in for the 3.3 plugin host: run the environment command for each
+    set of arguments that arrives, and reply once it is done.
+    """
+    command = EnvaultEnvironmentCommand(sublime.Window())
+    while True:
+        args = connection.recv()
+        if args is None:
+            return
+
+        command.run(**args)
+        sublime.run_timeouts()
+        connection.send(True)
+
+
+class BenchWindow(sublime.Window):
+    """
+    A window that runs the environment command of this host directly, and
+    the one of the other host as a round trip to its process.
+    """
+    def __init__(self, config_file, connection):
+        super().__init__({"envault": {"current": config_file}})
+        self.env_command = EnvaultEnvironmentCommand(self)
+        self.connection = connection
+        self.dispatches = 0
+
+    def run_command(self, command, args=None):
+        self.dispatches += 1
+        if command == ENV_COMMANDS["38"]:
+            self.env_command.run(**args)
+        elif command == ENV_COMMANDS["33"]:
+            self.connection.send(args)
+            self.connection.recv()
+
+
+## ----------------------------------------------------------------------------
+
+
+def run_hooks(listener, window, command):
+    """
+    Run the hooks for the given command in the window; a build also runs
+    the hooks of its target in between.
+    """
+    listener.on_window_command(window, command, {})
+    if command == "build":
+        listener.on_window_command(window, BUILD_TARGET, {})
+        listener.on_post_window_command(window, BUILD_TARGET, {})
+    listener.on_post_window_command(window, command, {})
+
+
+def bench(window, command, resolved, iterations):
+    """
+    Run the given command in the window the given number of times, and return
+    the number of environment command dispatches per run and the time that
+    each run took.
+    """
+    support.configure(added_watch_commands=[WATCHED_COMMAND])
+    command_hosts._command_hosts.clear()
+
+    registered = sublime_plugin.all_command_classes[1]
+    for cls in (BenchRunCommand, BenchBuildCommand):
+        if resolved and cls not in registered:
+            registered.append(cls)
+        elif not resolved and cls in registered:
+            registered.remove(cls)
+
+    listener = EnvaultEventListener()
+    window.dispatches = 0
+    times = []
+    for _ in range(iterations):
+        start = perf_counter()
+        run_hooks(listener, window, command)
+        times.append(perf_counter() - start)
+        sublime.run_timeouts()
+
+    return window.dispatches / iterations, times
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    config_file = "/bench/dispatch.yml"
+    store_env(config_file, {f"BENCH_VAR_{i}": f"value-{i}" for i in range(CONFIG_VARS)})
+
+    connection, child_connection = get_context("spawn").Pipe()
+    child = get_context("spawn").Process(target=other_host, args=(child_connection,))
+    child.start()
+
+    try:
+        window = BenchWindow(config_file, connection)
+
+        print(f"{'command':<10} {'mode':<7} {'dispatches':>10} {'p50':>8} {'p95':>8}")
+        for command in (WATCHED_COMMAND, "build"):
+            for mode in ("before", "after"):
+                dispatches, times = bench(window, command, mode == "after", iterations)
+                p95 = quantiles(times, n=20)[-1]
+                print(f"{command:<10} {mode:<7} {dispatches:>10.0f} "
+                      f"{median(times) * 1000:>8.3f} {p95 * 1000:>8.3f}")
+
+    finally:
+        connection.send(None)
+        child.join()
+
+
+if __name__ == "__main__":
+    main()
+
+
+## ----------------------------------------------------------------------------
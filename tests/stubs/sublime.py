@@ -0,0 +1,232 @@
+"""
+A stand-in for the parts of the Sublime Text API that the package uses, so
+that its modules can be imported and exercised outside of Sublime.
+
+Callbacks passed to set_timeout() and set_timeout_async() are queued rather
+than run, and are only run when run_timeouts() is called; this gives tests
+control over when "later" is.
+"""
+import json
+import tempfile
+
+from collections import deque
+from threading import Lock
+
+
+## ----------------------------------------------------------------------------
+
+
+platform = "linux"
+
+DIALOG_CANCEL = 0
+DIALOG_YES = 1
+DIALOG_NO = 2
+
+KIND_ID_AMBIGUOUS = 0
+
+
+class QuickPanelFlags():
+    NONE = 0
+    WANT_EVENT = 8
+
+
+class ListInputItem():
+    def __init__(self, text, value, details="", annotation="", kind=None):
+        self.text = text
+        self.value = value
+
+
+class QuickPanelItem():
+    def __init__(self, trigger, details="", annotation="", kind=None):
+        self.trigger = trigger
+
+
+## ----------------------------------------------------------------------------
+
+
+class Settings():
+    def __init__(self, name):
+        self.name = name
+        self.values = {}
+        self.listeners = {}
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+        for listener in list(self.listeners.values()):
+            listener()
+
+    def erase(self, key):
+        self.values.pop(key, None)
+
+    def has(self, key):
+        return key in self.values
+
+    def add_on_change(self, key, listener):
+        self.listeners[key] = listener
+
+    def clear_on_change(self, key):
+        self.listeners.pop(key, None)
+
+
+_settings = {}
+
+
+def load_settings(name):
+    if name not in _settings:
+        _settings[name] = Settings(name)
+
+    return _settings[name]
+
+
+def reset_settings():
+    """
+    Forget all settings objects, and with them all settings and listeners.
+    """
+    _settings.clear()
+
+
+## ----------------------------------------------------------------------------
+
+
+_timeouts = deque()
+_timeouts_lock = Lock()
+
+
+def set_timeout(callback, delay=0):
+    with _timeouts_lock:
+        _timeouts.append(callback)
+
+
+set_timeout_async = set_timeout
+
+
+def run_timeouts():
+    """
+    Run all queued timeout callbacks, including any that they queue in turn.
+    """
+    while True:
+        with _timeouts_lock:
+            if not _timeouts:
+                return
+            callback = _timeouts.popleft()
+
+        callback()
+
+
+def clear_timeouts():
+    with _timeouts_lock:
+        _timeouts.clear()
+
+
+## ----------------------------------------------------------------------------
+
+
+messages = []
+
+
+def status_message(msg):
+    messages.append(("status", msg))
+
+
+def error_message(msg):
+    messages.append(("error", msg))
+
+
+def message_dialog(msg):
+    messages.append(("dialog", msg))
+
+
+def yes_no_cancel_dialog(msg, yes_title="", no_title=""):
+    return DIALOG_YES
+
+
+def set_clipboard(text):
+    pass
+
+
+def decode_value(text):
+    return json.loads(text)
+
+
+def expand_variables(value, variables):
+    return value
+
+
+def load_resource(name):
+    return ""
+
+
+_cache_dir = tempfile.mkdtemp(prefix="envault-cache-")
+
+
+def cache_path():
+    return _cache_dir
+
+
+def packages_path():
+    return _cache_dir
+
+
+## ----------------------------------------------------------------------------
+
+
+class View():
+    def __init__(self, window=None):
+        self._window = window
+
+    def window(self):
+        return self._window
+
+    def file_name(self):
+        return None
+
+    def set_status(self, key, value):
+        pass
+
+    def erase_status(self, key):
+        pass
+
+
+class Window():
+    _next_id = 1
+
+    def __init__(self, project_data=None):
+        self._id = Window._next_id
+        Window._next_id += 1
+        self._project_data = project_data
+        self.commands = []
+
+    def id(self):
+        return self._id
+
+    def project_data(self):
+        return json.loads(json.dumps(self._project_data))
+
+    def set_project_data(self, data):
+        self._project_data = json.loads(json.dumps(data))
+
+    def folders(self):
+        return []
+
+    def views(self):
+        return []
+
+    def run_command(self, command, args=None):
+        self.commands.append((command, args))
+
+    def show_quick_panel(self, items, on_select, **kwargs):
+        self.commands.append(("show_quick_panel", items))
+
+
+_windows = []
+
+
+def windows():
+    return list(_windows)
+
+
+def active_window():
+    return _windows[0] if _windows else Window()
@@ -0,0 +1,51 @@
+"""
+A stand-in for the plugin API of Sublime Text; see sublime.py.
+"""
+import re
+
+
+## ----------------------------------------------------------------------------
+
+
+# The command classes that are loaded, as lists of application, window and
+# text commands.
+all_command_classes = [[], [], []]
+
+
+class Command():
+    def name(self):
+        name = type(self).__name__
+        if name.endswith("Command"):
+            name = name[:-7]
+
+        return re.sub(r"(?<!^)(?=[A-Z])", "_", name).lower()
+
+
+class ApplicationCommand(Command):
+    pass
+
+
+class WindowCommand(Command):
+    def __init__(self, window):
+        self.window = window
+
+
+class TextCommand(Command):
+    def __init__(self, view):
+        self.view = view
+
+
+class EventListener():
+    pass
+
+
+class ViewEventListener():
+    pass
+
+
+class ListInputHandler():
+    pass
+
+
+class TextInputHandler():
+    pass
@@ -0,0 +1,159 @@
+"""
+Shared set up for the tests and benchmarks.
+
+The package is normally loaded by Sublime Text as a package named Envault,
+using the sublime and sublime_plugin modules that the plugin host provides.
+Importing this module puts the stand-in versions of those modules from the
+stubs folder on the path and registers the root of the repository as the
+Envault package, so that the modules of the package can be imported as
+Envault.src.<module>.
+
+The tests use only the standard library and are run from the root of the
+repository with:
+
+    python -m unittest discover -s tests -b
+
+The benchmarks are the bench_*.py files, and are run directly:
+
+    python tests/bench_build_hook.py
+"""
+import sys
+import types
+
+from json import dumps
+from os.path import abspath, dirname, join
+from tempfile import mkdtemp
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import monotonic, sleep
+
+
+## ----------------------------------------------------------------------------
+
+
+ROOT = dirname(dirname(abspath(__file__)))
+
+sys.path.insert(0, join(ROOT, "tests", "stubs"))
+
+if "Envault" not in sys.modules:
+    package = types.ModuleType("Envault")
+    package.__path__ = [ROOT]
+    sys.modules["Envault"] = package
+
+import sublime
+
+import Envault.src
+from Envault.src import settings
+from Envault.src.commands import env_command
+
+
+## ----------------------------------------------------------------------------
+
+
+def configure(**values):
+    """
+    Replace the package settings with the ones given (every other setting has
+    its default value) and rebuild the settings snapshots.
+    """
+    sublime.reset_settings()
+    s = sublime.load_settings(settings.SETTINGS_FILE)
+    for key, value in values.items():
+        s.set(key, value)
+
+    settings.reload_settings()
+    env_command.load_command_settings()
+
+
+## ----------------------------------------------------------------------------
+
+
+class StandInServer():
+    """
+    A local HTTP server that stands in for an Envault server.
+
+    Each request is answered by calling respond(request_json, headers) to get
+    a tuple of the status, the response headers and the body (as bytes); the
+    requests that were made are kept in requests, as tuples of the decoded
+    body, the request headers and the request target.
+    """
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            # Headers and bodies are written separately; without this a small
+            # response stalls on a delayed ACK.
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                request = sublime.decode_value(body.decode("utf-8"))
+                server.requests.append((request, dict(self.headers), self.path))
+
+                status, headers, payload = server.respond(request, self.headers)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+        self.thread = Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def json_response(env, status=200, **headers):
+    """
+    Return a response for a StandInServer that carries the given environment
+    as a JSON object.
+    """
+    headers.setdefault("Content-Type", "application/json")
+    return status, headers, dumps(env).encode("utf-8")
+
+
+def write_config(url, specs):
+    """
+    Write an Envault config that fetches the given specs from the given server
+    to a new temporary folder, and return its filename.
+    """
+    config_file = join(mkdtemp(), "test.yml")
+    with open(config_file, "w") as file:
+        file.write(f"apiKeyName: ENVAULT_TEST_KEY\nurl: {url}\nvars: {specs!r}\n")
+
+    return config_file
+
+
+def wait_for(predicate, timeout=5.0):
+    """
+    Run queued timeout callbacks until the predicate is true, failing if that
+    takes longer than the given number of seconds.
+    """
+    deadline = monotonic() + timeout
+    while True:
+        sublime.run_timeouts()
+        if predicate():
+            return
+
+        if monotonic() > deadline:
+            raise AssertionError("timed out waiting for a condition")
+
+        sleep(0.01)
+
+
+## ----------------------------------------------------------------------------
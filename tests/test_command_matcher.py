@@ -0,0 +1,40 @@
+import unittest
+
+from support import configure
+
+from Envault.src.command_matcher import CommandMatcher
+from Envault.src.settings import ev_settings
+
+
+## ----------------------------------------------------------------------------
+
+
+class CommandMatcherTests(unittest.TestCase):
+    def test_names_globs_and_regexes(self):
+        matcher = CommandMatcher(["exec", "terminus_*", "re:my_(build|run)"])
+
+        self.assertIn("exec", matcher)
+        self.assertIn("terminus_open", matcher)
+        self.assertIn("my_build", matcher)
+        self.assertNotIn("exec_other", matcher)
+        self.assertNotIn("my_build_all", matcher)
+
+
+    def test_invalid_patterns_are_ignored(self):
+        matcher = CommandMatcher(["re:(", "terminus_*", 42, None, {"a": 1}, "exec"])
+
+        self.assertIn("exec", matcher)
+        self.assertIn("terminus_exec", matcher)
+        self.assertNotIn("42", matcher)
+
+
+    def test_settings_with_invalid_patterns_still_load(self):
+        configure(added_watch_commands=["terminus_*", 42],
+                  scoped_env_commands=["exec", ["nested"]])
+
+        settings = ev_settings()
+        self.assertIn("terminus_open", settings.watch_matcher)
+        self.assertEqual(settings.scoped_commands, frozenset(["exec"]))
+
+
+## ----------------------------------------------------------------------------
@@ -0,0 +1,168 @@
+import os
+import unittest
+
+from hashlib import sha256
+from hmac import new as hmac_new
+from json import dumps, loads
+from os import remove
+from os.path import exists
+from time import time
+
+from support import configure
+
+import sublime
+
+from Envault.src import disk_cache
+from Envault.src.disk_cache import persist_env, restore_envs, flush_disk_cache
+
+
+## ----------------------------------------------------------------------------
+
+
+class DiskCacheTests(unittest.TestCase):
+    def setUp(self):
+        configure(persistent_cache=True)
+        sublime.clear_timeouts()
+
+        self.saved_env = os.environ.copy()
+        os.environ["ENVAULT_TEST_KEY"] = "secret-key"
+
+        disk_cache._entries = None
+        disk_cache._pending.clear()
+        disk_cache._write_scheduled = False
+        if exists(disk_cache._cache_file()):
+            remove(disk_cache._cache_file())
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.saved_env)
+
+
+    def persist(self, config_file, env):
+        persist_env(config_file, "ENVAULT_TEST_KEY", env)
+        sublime.run_timeouts()
+
+        # Forget what was read, as if Sublime had been restarted.
+        disk_cache._entries = None
+
+    def restore(self):
+        restored = []
+        restore_envs(lambda envs: restored.append(envs))
+        sublime.run_timeouts()
+        return {c: env for c, (stored, env) in (restored[0] if restored else {}).items()}
+
+    def rewrite(self, change):
+        with open(disk_cache._cache_file(), encoding="utf-8") as file:
+            entries = loads(file.read())
+
+        change(entries)
+        with open(disk_cache._cache_file(), "w", encoding="utf-8") as file:
+            file.write(dumps(entries))
+
+        disk_cache._entries = None
+
+
+    def test_round_trip(self):
+        self.persist("/a.yml", {"SECRET": "value", "OTHER": "ünïcode"})
+
+        with open(disk_cache._cache_file(), encoding="utf-8") as file:
+            self.assertNotIn("value", file.read())
+
+        self.assertEqual(self.restore(), {"/a.yml": {"SECRET": "value", "OTHER": "ünïcode"}})
+
+
+    def test_changed_or_missing_api_key(self):
+        self.persist("/a.yml", {"SECRET": "value"})
+
+        os.environ["ENVAULT_TEST_KEY"] = "another-key"
+        self.assertEqual(self.restore(), {})
+
+        del os.environ["ENVAULT_TEST_KEY"]
+        self.assertEqual(self.restore(), {})
+
+
+    def test_tampered_entry(self):
+        self.persist("/a.yml", {"SECRET": "value"})
+
+        def tamper(entries):
+            data = bytearray(disk_cache.b64decode(entries["/a.yml"]["data"]))
+            data[0] ^= 1
+            entries["/a.yml"]["data"] = disk_cache.b64encode(bytes(data)).decode("ascii")
+
+        self.rewrite(tamper)
+        self.assertEqual(self.restore(), {})
+
+
+    def test_tampered_tag(self):
+        self.persist("/a.yml", {"SECRET": "value"})
+        self.rewrite(lambda e: e["/a.yml"].update(tag=disk_cache.b64encode(b"x" * 32).decode("ascii")))
+        self.assertEqual(self.restore(), {})
+
+
+    def test_entry_moved_to_another_config(self):
+        self.persist("/a.yml", {"SECRET": "value"})
+        self.rewrite(lambda e: e.update({"/b.yml": e.pop("/a.yml")}))
+        self.assertEqual(self.restore(), {})
+
+
+    def test_expired_entry(self):
+        self.persist("/a.yml", {"SECRET": "value"})
+        self.rewrite(lambda e: e["/a.yml"].update(stored=time() - 120))
+
+        configure(persistent_cache=True, persistent_cache_ttl=60)
+        self.assertEqual(self.restore(), {})
+
+        # Expired entries are dropped the next time the file is written.
+        self.persist("/b.yml", {"OTHER": "value"})
+        self.assertEqual(list(disk_cache._read_entries()), ["/b.yml"])
+
+
+    def test_damaged_file(self):
+        os.makedirs(os.path.dirname(disk_cache._cache_file()), exist_ok=True)
+        with open(disk_cache._cache_file(), "w") as file:
+            file.write("{not json")
+
+        self.assertEqual(self.restore(), {})
+
+        self.persist("/a.yml", {"SECRET": "value"})
+        self.assertEqual(self.restore(), {"/a.yml": {"SECRET": "value"}})
+
+
+    def test_flush_writes_what_is_encrypted(self):
+        # Encrypt the entry, as persisting it does in the background, but
+        # don't run the write that this schedules.
+        disk_cache._queue_env("/a.yml", "ENVAULT_TEST_KEY", {"SECRET": "value"})
+        sublime.clear_timeouts()
+        flush_disk_cache()
+
+        disk_cache._entries = None
+        self.assertEqual(self.restore(), {"/a.yml": {"SECRET": "value"}})
+
+
+    def test_derived_keys_are_bounded_and_hide_the_api_key(self):
+        disk_cache._derived_keys.clear()
+        for i in range(disk_cache.DERIVED_KEYS_SIZE + 3):
+            disk_cache._derive_keys("secret-key", bytes([i]) * 16)
+
+        self.assertEqual(len(disk_cache._derived_keys), disk_cache.DERIVED_KEYS_SIZE)
+        self.assertTrue(all(isinstance(k, bytes) and b"secret-key" not in k
+                            for k in disk_cache._derived_keys))
+
+
+    def test_keystream_matches_the_byte_at_a_time_version(self):
+        key, nonce = b"k" * 32, b"n" * 16
+        data = os.urandom(4096 + 5)
+
+        expected = bytearray(len(data))
+        for offset in range(0, len(data), 32):
+            block = hmac_new(key, nonce + offset.to_bytes(8, "big"), sha256).digest()
+            for i, byte in enumerate(data[offset:offset + 32]):
+                expected[offset + i] = byte ^ block[i]
+
+        encrypted = disk_cache._keystream_xor(key, nonce, data)
+        self.assertEqual(encrypted, bytes(expected))
+        self.assertEqual(disk_cache._keystream_xor(key, nonce, encrypted), data)
+        self.assertEqual(disk_cache._keystream_xor(key, nonce, b""), b"")
+
+
+## ----------------------------------------------------------------------------
@@ -0,0 +1,137 @@
+import unittest
+
+from support import configure
+
+import sublime
+
+from Envault.src import env_cache
+from Envault.src.env_cache import store_env, fetch_env, has_env
+from Envault.src.env_cache import store_response, cached_response
+from Envault.src.env_cache import store_spec_results, cached_spec_results
+from Envault.src.envault_data import forget_envault_config
+from Envault.src.env_store import env_layer
+
+
+## ----------------------------------------------------------------------------
+
+
+def make_env(name, count=200):
+    """
+    Return an environment with count variables whose names and values are
+    unique to the given name.
+    """
+    return {f"{name}_{i}": f"{name}-value-{i}" for i in range(count)}
+
+
+def env_size(env):
+    return env_layer(env).size
+
+
+## ----------------------------------------------------------------------------
+
+
+class EvictionTests(unittest.TestCase):
+    def setUp(self):
+        self.envs = {name: make_env(name) for name in "abcd"}
+
+        # Room for two of the environments, but not three.
+        self.limit = env_size(self.envs["a"]) * 5 // 2
+        configure(env_cache_max_bytes=self.limit, spec_cache_ttl=300)
+
+        env_cache._env_cache.clear()
+        env_cache._spec_cache.clear()
+        env_cache._response_cache.clear()
+        env_cache._restored.clear()
+        sublime._windows.clear()
+        forget_envault_config()
+
+
+    def test_least_recently_used_is_evicted(self):
+        store_env("/a", self.envs["a"])
+        store_env("/b", self.envs["b"])
+        fetch_env("/a")
+        store_env("/c", self.envs["c"])
+
+        self.assertTrue(has_env("/a"))
+        self.assertFalse(has_env("/b"))
+        self.assertTrue(has_env("/c"))
+        self.assertLessEqual(env_cache._cache_bytes(), self.limit)
+
+
+    def test_selected_configs_are_never_evicted(self):
+        sublime._windows.append(sublime.Window({"envault": {"current": "/a"}}))
+
+        store_env("/a", self.envs["a"])
+        store_env("/b", self.envs["b"])
+        store_env("/c", self.envs["c"])
+        store_env("/d", self.envs["d"])
+
+        self.assertTrue(has_env("/a"))
+        self.assertEqual(dict(fetch_env("/a")), self.envs["a"])
+
+
+    def test_shared_layers_are_counted_once(self):
+        store_env("/a", self.envs["a"])
+        store_env("/a2", dict(self.envs["a"]))
+        store_env("/a3", dict(self.envs["a"]))
+
+        self.assertEqual(env_cache._cache_bytes(), env_size(self.envs["a"]))
+        self.assertTrue(all(has_env(c) for c in ("/a", "/a2", "/a3")))
+
+
+    def test_no_limit(self):
+        configure(env_cache_max_bytes=0)
+        for name, env in self.envs.items():
+            store_env(f"/{name}", env)
+
+        self.assertTrue(all(has_env(f"/{name}") for name in self.envs))
+
+
+    def test_cached_responses_count_and_go_first(self):
+        store_response(("url", "key", ("a",), True), '"etag"', None, self.envs["c"], None)
+        store_env("/a", self.envs["a"])
+        store_env("/b", self.envs["b"])
+
+        self.assertIsNone(cached_response(("url", "key", ("a",), True)))
+        self.assertTrue(has_env("/a"))
+        self.assertTrue(has_env("/b"))
+
+
+    def test_cached_responses_share_layers_with_environments(self):
+        key = ("url", "key", ("a",), True)
+        store_response(key, '"etag"', None, self.envs["a"], None)
+        store_env("/a", cached_response(key).env_keys)
+        store_env("/b", self.envs["b"])
+
+        self.assertIsNotNone(cached_response(key))
+        self.assertTrue(has_env("/a"))
+        self.assertTrue(has_env("/b"))
+
+
+    def test_cached_specs_count_and_go_before_environments(self):
+        store_spec_results("url", "key", {"spec": self.envs["c"]})
+        store_env("/a", self.envs["a"])
+        store_env("/b", self.envs["b"])
+
+        self.assertEqual(cached_spec_results("url", "key", ["spec"]), ({}, ["spec"]))
+        self.assertTrue(has_env("/a"))
+        self.assertTrue(has_env("/b"))
+
+
+    def test_expired_specs_are_pruned(self):
+        store_spec_results("url", "key", {"old": {"OLD": "1"}})
+        key = ("url", "key", "old")
+        env_cache._spec_cache[key] = (env_cache._spec_cache[key][0] - 301,
+                                      env_cache._spec_cache[key][1])
+
+        store_spec_results("url", "key", {"new": {"NEW": "1"}})
+        self.assertEqual(list(env_cache._spec_cache), [("url", "key", "new")])
+
+
+    def test_specs_are_not_kept_when_the_cache_is_off(self):
+        configure(env_cache_max_bytes=self.limit, spec_cache_ttl=0)
+        store_spec_results("url", "key", {"spec": {"K": "v"}})
+        self.assertEqual(len(env_cache._spec_cache), 0)
+
+
+## ----------------------------------------------------------------------------
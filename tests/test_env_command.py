@@ -0,0 +1,159 @@
+import os
+import unittest
+
+from threading import Thread
+
+from support import configure
+
+import sublime
+
+from Envault.src.commands import env_command
+from Envault.src.commands.env_command import EnvaultEnvironmentCommand
+
+
+## ----------------------------------------------------------------------------
+
+
+class EnvironmentCommandTests(unittest.TestCase):
+    def setUp(self):
+        configure()
+        self.saved_env = os.environ.copy()
+        for var in ("SECRET_A", "SHARED", "ONLY_B", "ENVAULT", "ENVAULT_CONFIG"):
+            os.environ.pop(var, None)
+
+        env_command.env_state = env_command.EnvironmentState()
+        sublime.clear_timeouts()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.saved_env)
+
+
+    def command(self):
+        return EnvaultEnvironmentCommand(sublime.Window())
+
+
+    def test_set_and_restore(self):
+        cmd = self.command()
+        cmd.run("build", "set", "/a", {"SECRET_A": "x"}, 1)
+        self.assertEqual(os.environ["SECRET_A"], "x")
+        self.assertEqual(os.environ["ENVAULT_CONFIG"], "/a")
+
+        cmd.run("build", "restore", "", {})
+        sublime.run_timeouts()
+        self.assertNotIn("SECRET_A", os.environ)
+        self.assertNotIn("ENVAULT", os.environ)
+
+
+    def test_windows_share_what_is_applied(self):
+        first, second = self.command(), self.command()
+        first.run("build", "set", "/a", {"SECRET_A": "x", "SHARED": "a"}, 1)
+        second.run("build", "set", "/b", {"SHARED": "b"}, 2)
+
+        self.assertNotIn("SECRET_A", os.environ)
+        self.assertEqual(os.environ["SHARED"], "b")
+
+        second.run("build", "restore", "", {})
+        sublime.run_timeouts()
+        self.assertEqual(os.environ["SECRET_A"], "x")
+
+        first.run("build", "restore", "", {})
+        sublime.run_timeouts()
+        self.assertNotIn("SECRET_A", os.environ)
+        self.assertNotIn("SHARED", os.environ)
+
+
+    def test_nested_commands_restore_the_outer_environment(self):
+        cmd = self.command()
+        cmd.run("build", "set", "/a", {"SHARED": "a"}, 1)
+        cmd.run("exec", "set", "/b", {"SHARED": "b", "ONLY_B": "1"}, 2)
+
+        cmd.run("exec", "restore", "", {})
+        sublime.run_timeouts()
+        self.assertEqual(os.environ["SHARED"], "a")
+        self.assertNotIn("ONLY_B", os.environ)
+
+
+    def test_restore_does_not_undo_a_later_set(self):
+        cmd = self.command()
+        cmd.run("build", "set", "/a", {"SHARED": "a"}, 1)
+        cmd.run("build", "restore", "", {})
+        cmd.run("build", "set", "/b", {"SHARED": "b"}, 2)
+
+        # The restore of the first build only happens now, after the second
+        # build has started.
+        sublime.run_timeouts()
+        self.assertEqual(os.environ["SHARED"], "b")
+
+
+    def test_restores_racing_with_sets(self):
+        cmd = self.command()
+        for generation in range(1, 200):
+            cmd.run("build", "set", "/a", {"SHARED": str(generation)}, generation)
+            cmd.run("build", "restore", "", {})
+
+            # Run the restore on another thread while the next build starts.
+            restore = Thread(target=sublime.run_timeouts)
+            restore.start()
+            cmd.run("exec", "set", "/b", {"SHARED": "b"}, 1000 + generation)
+            restore.join()
+
+            self.assertEqual(os.environ["SHARED"], "b")
+            cmd.run("exec", "restore", "", {})
+            sublime.run_timeouts()
+            self.assertNotIn("SHARED", os.environ)
+
+
+    def test_same_command_nested_restores_most_recent(self):
+        cmd = self.command()
+        cmd.run("exec", "set", "/a", {"SHARED": "a"}, 1)
+        cmd.run("exec", "set", "/b", {"SHARED": "b"}, 2)
+
+        cmd.run("exec", "restore", "", {})
+        sublime.run_timeouts()
+        self.assertEqual(os.environ["SHARED"], "a")
+
+
+    def test_lost_restore_does_not_pin_the_environment(self):
+        cmd = self.command()
+        cmd.run("terminus_open", "set", "/a", {"SECRET_A": "x"}, 1)
+
+        # The restore for terminus_open never comes; once its frame is old
+        # enough, the next restore drops it.
+        command, target, started = env_command.env_state.frames[0]
+        env_command.env_state.frames[0] = (command, target,
+                                           started - env_command.EnvironmentState.MAX_FRAME_AGE - 1)
+
+        cmd.run("build", "set", "/b", {"SHARED": "b"}, 2)
+        cmd.run("build", "restore", "", {})
+        sublime.run_timeouts()
+        self.assertNotIn("SECRET_A", os.environ)
+        self.assertNotIn("SHARED", os.environ)
+        self.assertEqual(env_command.env_state.frames, [])
+
+
+    def test_restore_without_a_set_drops_stale_frames(self):
+        cmd = self.command()
+        cmd.run("terminus_open", "set", "/a", {"SECRET_A": "x"}, 1)
+        command, target, started = env_command.env_state.frames[0]
+        env_command.env_state.frames[0] = (command, target,
+                                           started - env_command.EnvironmentState.MAX_FRAME_AGE - 1)
+
+        cmd.run("exec", "restore", "", {})
+        sublime.run_timeouts()
+        self.assertNotIn("SECRET_A", os.environ)
+
+
+    def test_changes_are_prepared_once_per_generation(self):
+        cmd = self.command()
+        cmd.run("build", "set", "/a", {"SHARED": "a"}, 1)
+        prepared = env_command.env_state.prepared["/a"]
+
+        cmd.run("build", "set", "/a", {"SHARED": "a"}, 1)
+        self.assertIs(env_command.env_state.prepared["/a"], prepared)
+
+        cmd.run("build", "set", "/a", {"SHARED": "changed"}, 2)
+        self.assertEqual(os.environ["SHARED"], "changed")
+
+
+## ----------------------------------------------------------------------------
@@ -0,0 +1,192 @@
+import unittest
+
+from support import StandInServer, json_response, configure, wait_for, write_config
+
+import sublime
+import sublime_plugin
+
+from Envault.src import command_hosts, env_cache, fetch_registry
+from Envault.src.config_file import load_and_fetch_config
+from Envault.src.env_cache import store_env
+from Envault.src.events import EnvaultEventListener
+
+
+## ----------------------------------------------------------------------------
+
+
+class HostTargetCommand(sublime_plugin.WindowCommand):
+    pass
+
+
+class BuildDispatchTests(unittest.TestCase):
+    """
+    The environment for a build is set in the plugin host of the command that
+    the build runs, once it runs it.
+    """
+    def setUp(self):
+        configure()
+        store_env("/build.yml", {"SECRET": "x"})
+
+        self.window = sublime.Window({"envault": {"current": "/build.yml"}})
+        self.listener = EnvaultEventListener()
+        self.listener.pending_builds.clear()
+        self.listener.env_hosts.clear()
+        command_hosts._command_hosts.clear()
+
+        sublime_plugin.all_command_classes[1].append(HostTargetCommand)
+
+    def tearDown(self):
+        sublime_plugin.all_command_classes[1].remove(HostTargetCommand)
+
+
+    def build(self, target=None):
+        self.listener.on_window_command(self.window, "build", {})
+        if target is not None:
+            self.listener.on_window_command(self.window, target, {})
+            self.listener.on_post_window_command(self.window, target, {})
+        self.listener.on_post_window_command(self.window, "build", {})
+
+        return [(cmd, args["operation"], args["command"]) for cmd, args in self.window.commands]
+
+
+    def test_resolved_target_uses_one_host(self):
+        self.assertEqual(self.build("host_target"), [
+            ("envault_internal_env_38", "set", "build"),
+            ("envault_internal_env_38", "restore", "build"),
+        ])
+
+
+    def test_unresolved_target_uses_both_hosts(self):
+        self.assertEqual([op for _, op, _ in self.build("unknown_target")],
+                         ["set", "set", "restore", "restore"])
+
+
+    def test_build_without_target_does_nothing(self):
+        self.assertEqual(self.build(), [])
+
+
+class RevalidationTests(unittest.TestCase):
+    """
+    Commands that run with a stale environment refresh it in the background,
+    but never for a config that has not loaded, and not over and over for a
+    config whose fetch keeps failing.
+    """
+    def setUp(self):
+        configure(fetch_batch_delay=0, fetch_retries=0, env_cache_ttl=1)
+        sublime.clear_timeouts()
+        del sublime.messages[:]
+
+        self.status = 401
+        self.server = StandInServer(self.respond)
+        self.listener = EnvaultEventListener()
+
+    def tearDown(self):
+        self.server.close()
+
+
+    def respond(self, request, headers):
+        if self.status != 200:
+            return self.status, {}, b"{}"
+
+        return json_response({"KEY": "value"})
+
+
+    def build(self, config_file, count=3):
+        window = sublime.Window({"envault": {"current": config_file}})
+        for _ in range(count):
+            self.listener.on_window_command(window, "build", {})
+            self.listener.on_post_window_command(window, "build", {})
+            sublime.run_timeouts()
+
+
+    def errors(self):
+        return [m for m in sublime.messages if m[0] == "error"]
+
+
+    def test_missing_config_is_not_loaded_by_builds(self):
+        self.build("/does/not/exist.yml")
+        self.assertEqual(self.errors(), [])
+
+
+    def test_failed_config_is_not_fetched_on_every_build(self):
+        config_file = write_config(self.server.url, ["spec"])
+        done = []
+        load_and_fetch_config(config_file, lambda c: done.append(c))
+        wait_for(lambda: done)
+        self.assertEqual(len(self.server.requests), 1)
+
+        self.build(config_file)
+        self.assertEqual(len(self.server.requests), 1)
+
+        # Once enough time has passed, the next build tries again.
+        self.status = 200
+        env_cache._failed_at[config_file] -= env_cache.FAILED_REFRESH_INTERVAL
+        self.build(config_file, 1)
+        wait_for(lambda: dict(env_cache.fetch_env(config_file)) == {"KEY": "value"})
+        self.assertEqual(len(self.server.requests), 2)
+
+
+    def test_stale_environment_is_refreshed_after_the_command(self):
+        self.status = 200
+        config_file = write_config(self.server.url, ["spec"])
+        store_env(config_file, {"KEY": "old"})
+        env_cache._env_cache[config_file] = (0, env_cache._env_cache[config_file][1])
+
+        window = sublime.Window({"envault": {"current": config_file}})
+        self.listener.on_window_command(window, "build", {})
+        self.listener.on_window_command(window, "build", {})
+        self.assertFalse(fetch_registry.is_fetching(config_file))
+
+        wait_for(lambda: dict(env_cache.fetch_env(config_file)) == {"KEY": "value"})
+        self.assertEqual(len(self.server.requests), 1)
+
+
+## ----------------------------------------------------------------------------
+
+
+class ScopedInjectionTests(unittest.TestCase):
+    def setUp(self):
+        configure(env_injection="scoped", added_watch_commands=["terminus_open"])
+        store_env("/scoped.yml", {"SECRET": "x"})
+
+        self.window = sublime.Window({"envault": {"current": "/scoped.yml"}})
+        self.listener = EnvaultEventListener()
+        self.listener.pending_builds.clear()
+
+
+    def test_unwatched_command_is_left_alone(self):
+        self.assertIsNone(self.listener.on_window_command(self.window, "exec", {"cmd": "ls"}))
+
+
+    def test_build_target_is_given_the_environment(self):
+        self.assertIsNone(self.listener.on_window_command(self.window, "build", {}))
+
+        cmd, args = self.listener.on_window_command(self.window, "exec",
+                                                    {"cmd": "make", "env": {"SECRET": "mine"}})
+        self.assertEqual(cmd, "exec")
+        self.assertEqual(args["env"]["SECRET"], "mine")
+        self.assertEqual(args["env"]["ENVAULT_CONFIG"], "/scoped.yml")
+
+        # Only the one command that the build ran.
+        self.listener.on_post_window_command(self.window, "build", {})
+        self.assertIsNone(self.listener.on_window_command(self.window, "exec", {}))
+
+
+    def test_build_in_another_window_does_not_leak(self):
+        other = sublime.Window({"envault": {"current": "/scoped.yml"}})
+        self.listener.on_window_command(other, "build", {})
+        self.assertIsNone(self.listener.on_window_command(self.window, "exec", {}))
+
+
+    def test_build_without_scoped_target_leaves_nothing_pending(self):
+        self.listener.on_window_command(self.window, "build", {})
+        self.listener.on_post_window_command(self.window, "build", {})
+        self.assertIsNone(self.listener.on_window_command(self.window, "exec", {}))
+
+
+    def test_watched_command_is_given_the_environment(self):
+        cmd, args = self.listener.on_window_command(self.window, "terminus_open", {})
+        self.assertEqual(args["env"]["SECRET"], "x")
+
+
+## ----------------------------------------------------------------------------
@@ -0,0 +1,171 @@
+import unittest
+
+from support import StandInServer, json_response, configure, wait_for, write_config
+
+from Envault.src.config_file import load_and_fetch_config
+from Envault.src.env_cache import fetch_env
+from Envault.src import fetch_registry
+
+
+## ----------------------------------------------------------------------------
+
+
+class FetchCompletionTests():
+    """
+    A fetch has to complete (and leave the in-flight registry) no matter how
+    the request fails, or every later fetch of the same config attaches to it
+    and waits forever. This is run against both fetch backends.
+    """
+    backend = None
+
+    def setUp(self):
+        configure(fetch_backend=self.backend, fetch_batch_delay=0, fetch_retries=0)
+        self.responses = []
+        self.server = StandInServer(lambda request, headers: self.responses.pop(0))
+
+    def tearDown(self):
+        self.server.close()
+
+
+    def fetch(self, config_file):
+        done = []
+        load_and_fetch_config(config_file, lambda c: done.append(c))
+        wait_for(lambda: done)
+
+
+    def test_invalid_body_completes(self):
+        config_file = write_config(self.server.url, ["spec"])
+
+        self.responses.append((200, {"Content-Type": "text/html"}, b"<html>proxy</html>"))
+        self.fetch(config_file)
+        self.assertNotIn(config_file, fetch_registry._in_flight)
+        self.assertEqual(dict(fetch_env(config_file)), {})
+
+        self.responses.append(json_response({"KEY": "value"}))
+        self.fetch(config_file)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(dict(fetch_env(config_file)), {"KEY": "value"})
+
+
+    def test_non_object_body_completes(self):
+        config_file = write_config(self.server.url, ["spec"])
+
+        self.responses.append(json_response(["not", "a", "dict"]))
+        self.fetch(config_file)
+        self.assertNotIn(config_file, fetch_registry._in_flight)
+
+        self.responses.append(json_response({"KEY": "value"}))
+        self.fetch(config_file)
+        self.assertEqual(dict(fetch_env(config_file)), {"KEY": "value"})
+
+
+class SplitFetchTests(unittest.TestCase):
+    """
+    Servers that split their results by spec have them cached per spec, and
+    conditional requests re-use the results of the cached response.
+    """
+    def setUp(self):
+        configure(fetch_batch_delay=0, spec_cache_ttl=300)
+        self.server = StandInServer(self.respond)
+
+    def tearDown(self):
+        self.server.close()
+
+
+    def respond(self, specs, headers):
+        if headers.get("If-None-Match") == '"v1"':
+            return 304, {"ETag": '"v1"'}, b""
+
+        return json_response({spec: {spec.upper(): spec} for spec in specs},
+                             ETag='"v1"', **{"envault-format": "split"})
+
+
+    def fetch(self, config_file):
+        done = []
+        load_and_fetch_config(config_file, lambda c: done.append(c))
+        wait_for(lambda: done)
+        return dict(fetch_env(config_file))
+
+
+    def test_split_results_are_cached_by_spec(self):
+        first = write_config(self.server.url, ["one", "two"])
+        second = write_config(self.server.url, ["two", "three"])
+
+        self.assertEqual(self.fetch(first), {"ONE": "one", "TWO": "two"})
+        self.assertEqual(self.fetch(second), {"TWO": "two", "THREE": "three"})
+        self.assertEqual(self.server.requests[-1][0], ["three"])
+
+
+    def test_not_modified_reuses_the_cached_response(self):
+        configure(fetch_batch_delay=0, spec_cache_ttl=0)
+        config_file = write_config(self.server.url, ["one"])
+
+        self.assertEqual(self.fetch(config_file), {"ONE": "one"})
+        self.assertEqual(self.fetch(config_file), {"ONE": "one"})
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class BatchingTests(unittest.TestCase):
+    """
+    Configs that load together and use the same server are sent as a single
+    request, even before anything is known about the server.
+    """
+    def setUp(self):
+        configure(fetch_batch_delay=10, spec_cache_ttl=300)
+        self.split = True
+        self.server = StandInServer(self.respond)
+
+    def tearDown(self):
+        self.server.close()
+
+
+    def respond(self, specs, headers):
+        if self.split:
+            return json_response({spec: {spec.upper(): spec} for spec in specs},
+                                 **{"envault-format": "split"})
+
+        return json_response({spec.upper(): spec for spec in specs})
+
+
+    def fetch_all(self, config_files):
+        done = []
+        for config_file in config_files:
+            load_and_fetch_config(config_file, lambda c: done.append(c))
+
+        wait_for(lambda: len(done) == len(config_files))
+        return [dict(fetch_env(config_file)) for config_file in config_files]
+
+
+    def test_different_vars_share_one_request(self):
+        config_files = [write_config(self.server.url, ["shared", f"own{i}"]) for i in range(5)]
+
+        envs = self.fetch_all(config_files)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.server.requests[0][0].count("shared"), 1)
+        self.assertEqual(envs[3], {"SHARED": "shared", "OWN3": "own3"})
+
+
+    def test_server_that_does_not_split_is_fetched_individually(self):
+        self.split = False
+        config_files = [write_config(self.server.url, ["shared", f"own{i}"]) for i in range(3)]
+
+        envs = self.fetch_all(config_files)
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(envs[1], {"SHARED": "shared", "OWN1": "own1"})
+
+        # Now that the server is known not to split, there is no combined
+        # request first.
+        config_files = [write_config(self.server.url, ["shared", f"other{i}"]) for i in range(2)]
+        self.fetch_all(config_files)
+        self.assertEqual(len(self.server.requests), 6)
+
+
+class ThreadFetchCompletionTests(FetchCompletionTests, unittest.TestCase):
+    backend = "thread"
+
+
+class AsyncFetchCompletionTests(FetchCompletionTests, unittest.TestCase):
+    backend = "asyncio"
+
+
+## ----------------------------------------------------------------------------
@@ -0,0 +1,84 @@
+import unittest
+
+from support import configure
+
+from urllib.error import URLError
+
+from Envault.src import resilience
+from Envault.src.resilience import with_retries, run_blocking, circuit_for
+from Envault.src.resilience import CircuitBreaker, CircuitOpenError
+
+
+## ----------------------------------------------------------------------------
+
+
+class RetryTests(unittest.TestCase):
+    def setUp(self):
+        configure(fetch_retries=2, fetch_retry_delay=0,
+                  circuit_breaker_threshold=3, circuit_breaker_cooldown=30)
+        resilience._breakers.clear()
+        self.attempts = 0
+
+
+    def fetch(self, host, outcomes):
+        """
+        Make a fetch from the given host whose attempts have the outcomes
+        given, in order; an outcome that is an exception is raised.
+        """
+        outcomes = list(outcomes)
+
+        async def attempt():
+            self.attempts += 1
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        async def sleep(delay):
+            return False
+
+        return run_blocking(with_retries(host, "url", attempt, sleep))
+
+
+    def test_transient_failures_are_retried(self):
+        result, error = self.fetch("a", [URLError(OSError()), URLError(OSError()), {"K": "v"}])
+        self.assertEqual((result, error), ({"K": "v"}, None))
+        self.assertEqual(self.attempts, 3)
+
+
+    def test_one_failed_fetch_does_not_open_the_breaker(self):
+        result, error = self.fetch("a", [URLError(OSError())] * 3)
+        self.assertIsNone(result)
+        self.assertIsInstance(error, URLError)
+        self.assertEqual(self.attempts, 3)
+        self.assertEqual(circuit_for("a").state, CircuitBreaker.CLOSED)
+
+
+    def test_threshold_failed_fetches_open_the_breaker(self):
+        for _ in range(3):
+            self.fetch("a", [URLError(OSError())] * 3)
+
+        self.assertEqual(circuit_for("a").state, CircuitBreaker.OPEN)
+
+        self.attempts = 0
+        result, error = self.fetch("a", [{"K": "v"}])
+        self.assertIsInstance(error, CircuitOpenError)
+        self.assertEqual(self.attempts, 0)
+
+
+    def test_unanswered_probe_does_not_hold_the_breaker(self):
+        breaker = circuit_for("a")
+        for _ in range(3):
+            breaker.record_failure()
+
+        breaker.opened_at -= 30
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+        # The probe never reports back; after another cool down, a new probe
+        # is let through.
+        breaker.opened_at -= 30
+        self.assertTrue(breaker.allow())
+
+
+## ----------------------------------------------------------------------------